@@ -0,0 +1,214 @@
+import statistics as stats
+
+import episode_linking
+
+
+# Aggregates of the activity log for the process mining dashboard, so it reads small tables instead of the whole
+# 'activity_log' collection. Activities of each episode are ordered by timestamp (activity log order on ties, missing
+# timestamps last), as the dashboard event log orders them, and summarized by:
+#
+#   * 'activity_dfg': directly-follows edges (including the 'Start' and 'End' of the episodes) with their frequency
+#     and the mean and median transition duration (hours)
+#   * 'activity_variants': trace variants (sequence of activities) with their frequency and cumulative coverage
+#   * 'activity_resources': activity instances and episodes per resource (hospital or urgent care facility)
+#
+# Episodes are grouped as the dashboard tabs: all of them, and the ischaemic and hemorrhagic strokes by their first
+# hospital diagnosis. Edges are computed for all the variants (coverage 1.0) and for the most frequent variants that
+# cover 'coverage' of the episodes of the group (as the dashboard process maps filter them), the last variant included
+# being the one that reaches the coverage
+
+AGGREGATE_COLLECTIONS = ["activity_dfg", "activity_variants", "activity_resources"]
+
+# Fields of the activity log documents used by the aggregates (e.g. to read them back from MongoDB)
+ACTIVITY_FIELDS = ["id", "event", "timestamp", "resource", "hospital_diagnosis_code"]
+
+STROKE_GROUPS = {'I': 'ischaemic', 'H': 'hemorrhagic'}
+ALL_EPISODES = 'all'
+
+START_ACTIVITY = 'Start'
+END_ACTIVITY = 'End'
+
+VARIANT_SEPARATOR = ','
+
+HOUR = 3600.0
+
+
+def missing(value):
+    # None, NaN or NaT (neither is equal to itself)
+    return value is None or value != value
+
+
+def timestamp_key(document):
+    timestamp = document.get('timestamp')
+    return (True, 0) if missing(timestamp) else (False, timestamp)
+
+
+def timestamp_order(documents):
+    # Stable sort, so activities with the same timestamp keep the activity log order
+    return sorted(documents, key=timestamp_key)
+
+
+def episode_groups(documents):
+    # Groups of an episode (timestamp ordered documents): all episodes, and the stroke type of its first hospital
+    # diagnosis
+    groups = [ALL_EPISODES]
+
+    diagnosis_codes = [document.get('hospital_diagnosis_code') for document in documents
+                       if not missing(document.get('hospital_diagnosis_code'))]
+
+    if len(diagnosis_codes) > 0:
+        stroke_type = episode_linking.StrokeCodes().get_type(diagnosis_codes[0])
+
+        if stroke_type is not None and stroke_type[0] in STROKE_GROUPS:
+            groups.append(STROKE_GROUPS[stroke_type[0]])
+
+    return groups
+
+
+def transition_hours(from_document, to_document):
+    if missing(from_document.get('timestamp')) or missing(to_document.get('timestamp')):
+        return None
+
+    return (to_document['timestamp'] - from_document['timestamp']).total_seconds() / HOUR
+
+
+def duration_summary(durations):
+    # Mean and median of the known durations, None if there are none
+    durations = [duration for duration in durations if duration is not None]
+
+    if len(durations) == 0:
+        return None, None
+
+    return stats.fmean(durations), stats.median(durations)
+
+
+class ActivityAggregator:
+
+    def __init__(self, coverage=0.95):
+        self.coverage = coverage
+
+        # (group, variant) -> transition durations (hours) of each episode of the variant, one per directly-follows
+        # edge of the variant
+        self.variant_durations = {}
+
+        # (group, resource, activity) -> [activity instances, episode ids]
+        self.resources = {}
+
+    def add_episode(self, documents):
+        # Activity log documents of a single episode
+        documents = timestamp_order(documents)
+
+        if len(documents) == 0:
+            return
+
+        variant = tuple(document['event'] for document in documents)
+        durations = tuple(transition_hours(from_document, to_document)
+                          for from_document, to_document in zip(documents, documents[1:]))
+
+        for group in episode_groups(documents):
+            self.variant_durations.setdefault((group, variant), []).append(durations)
+
+            for document in documents:
+                resource = self.resources.setdefault((group, document.get('resource'), document['event']), [0, set()])
+                resource[0] += 1
+                resource[1].add(document['id'])
+
+    def add_activity_log(self, documents):
+        # Activity log documents of any number of episodes, in any order (e.g. read back from the output)
+        episodes = {}
+
+        for document in documents:
+            episodes.setdefault(document['id'], []).append(document)
+
+        for episode_documents in episodes.values():
+            self.add_episode(episode_documents)
+
+    def sorted_variants(self):
+        # group -> [(variant, episodes)], most frequent first (ties by variant)
+        result = {}
+
+        for (group, variant), durations in self.variant_durations.items():
+            result.setdefault(group, []).append((variant, len(durations)))
+
+        for group_variants in result.values():
+            group_variants.sort(key=lambda item: (-item[1], item[0]))
+
+        return result
+
+    def variants(self):
+        result = []
+
+        for group, group_variants in self.sorted_variants().items():
+            total_episodes = sum(episodes for variant, episodes in group_variants)
+            covered_episodes = 0
+
+            for rank, (variant, episodes) in enumerate(group_variants, start=1):
+                covered_episodes += episodes
+
+                result.append({'group': group,
+                               'rank': rank,
+                               'variant': VARIANT_SEPARATOR.join(variant),
+                               'activities': len(variant),
+                               'episodes': episodes,
+                               'relative_frequency': episodes / total_episodes,
+                               'cumulative_frequency': covered_episodes / total_episodes})
+
+        return result
+
+    def covered_variants(self, group_variants, coverage):
+        total_episodes = sum(episodes for variant, episodes in group_variants)
+        covered_episodes = 0
+
+        for variant, episodes in group_variants:
+            if covered_episodes >= coverage * total_episodes:
+                break
+
+            covered_episodes += episodes
+            yield variant
+
+    def dfg(self):
+        result = []
+
+        for group, group_variants in self.sorted_variants().items():
+            for coverage in sorted({1.0, self.coverage}, reverse=True):
+
+                # (from, to) -> [episodes, durations]
+                edges = {}
+
+                for variant in self.covered_variants(group_variants, coverage):
+                    variant_durations = self.variant_durations[(group, variant)]
+
+                    activities = (START_ACTIVITY,) + variant + (END_ACTIVITY,)
+
+                    for position, edge in enumerate(zip(activities, activities[1:])):
+                        edge_stats = edges.setdefault(edge, [0, []])
+                        edge_stats[0] += len(variant_durations)
+
+                        # Start and End edges have no duration
+                        if 0 < position < len(variant):
+                            edge_stats[1].extend(durations[position - 1] for durations in variant_durations)
+
+                for (from_activity, to_activity), (episodes, durations) in edges.items():
+                    mean_hours, median_hours = duration_summary(durations)
+
+                    result.append({'group': group,
+                                   'coverage': coverage,
+                                   'from_activity': from_activity,
+                                   'to_activity': to_activity,
+                                   'frequency': episodes,
+                                   'mean_hours': mean_hours,
+                                   'median_hours': median_hours})
+
+        return result
+
+    def resource_counts(self):
+        return [{'group': group,
+                 'resource': resource,
+                 'activity': activity,
+                 'activities': activities,
+                 'episodes': len(episode_ids)}
+                for (group, resource, activity), (activities, episode_ids) in self.resources.items()]
+
+    def aggregates(self):
+        # Documents of each aggregate collection
+        return dict(zip(AGGREGATE_COLLECTIONS, [self.dfg(), self.variants(), self.resource_counts()]))
@@ -0,0 +1,110 @@
+import argparse
+import json
+import math
+import os
+import shlex
+import subprocess
+import sys
+
+import pandas as pd
+from tabulate import tabulate
+
+import synthetic_data
+
+
+# Scalability benchmark of the event log builder. For each dataset size (number of events), synthetic datasets are
+# generated (see 'synthetic_data') and the builder is run on them with a profile report (see 'phase_profiler'). Phase
+# throughputs (rows per second) are reported for every size, and all the phase measures are written to a CSV file to
+# plot the throughput curves.
+
+REPOSITORY_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_builder(paths, builder_args, report_path, log_path):
+    command = [sys.executable, os.path.join(REPOSITORY_DIR, 'event_log_builder.py'),
+               paths['hospital_events'], paths['urgent_care_events'], paths['patients_data'],
+               '--profile-report', report_path] + builder_args
+
+    # The builder reads the stroke codes relative to the repository
+    with open(log_path, 'w') as log:
+        completed = subprocess.run(command, cwd=REPOSITORY_DIR, stdout=log, stderr=subprocess.STDOUT)
+
+    if completed.returncode != 0:
+        raise RuntimeError("Builder failed (see '" + log_path + "'): " + " ".join(command))
+
+    with open(report_path) as f:
+        return json.load(f)
+
+
+def benchmark(sizes, work_dir, events_per_patient, hospital_event_rate, builder_args, seed):
+    # One row per size and phase
+    results = []
+
+    stroke_codes = synthetic_data.read_stroke_codes(os.path.join(REPOSITORY_DIR, 'data', 'stroke_codes.csv'))
+
+    for size in sizes:
+        size_dir = os.path.join(work_dir, 'events_' + str(size))
+
+        options = synthetic_data.GeneratorOptions(patients=max(1, math.ceil(size / events_per_patient)),
+                                                  events_per_patient=events_per_patient,
+                                                  hospital_event_rate=hospital_event_rate,
+                                                  seed=seed)
+        paths, rows = synthetic_data.generate(size_dir, options, stroke_codes)
+
+        events = rows['hospital_events'] + rows['urgent_care_events']
+        print("Running the builder with " + str(events) + " events (" + str(options.patients) + " patients)")
+
+        size_builder_args = [arg.replace('{dir}', size_dir) for arg in builder_args]
+        report = run_builder(paths, size_builder_args, os.path.join(size_dir, 'profile_report.json'),
+                             os.path.join(size_dir, 'builder.log'))
+
+        for phase in report['phases']:
+            results.append(dict(phase, events=events, patients=options.patients))
+
+        results.append({'events': events, 'patients': options.patients, 'name': 'Total',
+                        'wall_time': report['total_wall_time'], 'cpu_time': report['total_cpu_time'],
+                        'peak_rss_mb': report['peak_rss_mb'], 'rows': events,
+                        'rows_per_sec': events / report['total_wall_time'] if report['total_wall_time'] > 0 else None})
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Scalability benchmark of the Code Stroke log generator')
+    parser.add_argument('work_dir', type=str, help='Directory of the generated datasets, builder logs and reports')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Number of events of each benchmark run (default 1000 10000 100000, up to 10^7 '
+                             'requires several GB of memory and disk)')
+    parser.add_argument('--events-per-patient', type=float, default=3.0,
+                        help='Mean number of events per patient (default 3)')
+    parser.add_argument('--hospital-event-rate', type=float, default=0.45,
+                        help='Fraction of events that are hospital events (default 0.45)')
+    parser.add_argument('--builder-args', type=str, default='--output parquet --output-dir {dir}/output',
+                        help='Additional builder arguments, "{dir}" is replaced by the directory of each run '
+                             '(default "--output parquet --output-dir {dir}/output")')
+    parser.add_argument('--results', type=str, default=None,
+                        help='CSV file of the measures of every phase and size (default: '
+                             '"benchmark_results.csv" in the work directory)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed of the synthetic datasets (default 1)')
+
+    args = parser.parse_args()
+
+    try:
+        benchmark_results = benchmark(args.sizes, args.work_dir, args.events_per_patient, args.hospital_event_rate,
+                                      shlex.split(args.builder_args), args.seed)
+    except RuntimeError as e:
+        print(str(e), file=sys.stderr)
+        exit(-1)
+
+    results_path = args.results if args.results is not None else os.path.join(args.work_dir, 'benchmark_results.csv')
+    benchmark_results.to_csv(results_path, index=False)
+
+    # Throughput curves: rows per second of each phase (rows) for each number of events (columns)
+    throughput = benchmark_results.pivot_table(index='name', columns='events', values='rows_per_sec', sort=False)
+
+    print("")
+    print("Throughput (rows/sec.)")
+    print(tabulate(throughput, headers=['phase'] + [str(events) + " events" for events in throughput.columns],
+                   tablefmt='psql', floatfmt='.0f'))
+    print("Phase measures written to '" + results_path + "'")
@@ -0,0 +1,304 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import event_log_builder
+
+
+# Long-lived build service on localhost. Builds are submitted over HTTP as jobs, and run one at a time in the service
+# process (builds share the StrokeCodes and StudyData singletons). The process keeps the modules imported, the stroke
+# codes catalog loaded and the parsed input datasets in memory (see 'input_data.DatasetMemoryCache'), so frequent
+# small rebuilds do not pay the start-up of the builder. Requests and responses are JSON documents:
+#
+#   * POST /jobs: submits a build of the given input datasets with the given builder options (see
+#     'event_log_builder.build_options'), e.g. {"hospital_events": "...", "urgent_care_events": "...",
+#     "patients_data": "...", "options": {"output": "parquet"}}. Returns the id of the job
+#   * GET /jobs: status of every job
+#   * GET /jobs/<id>: status of a job, the builder output so far and, once finished, the statistics, erroneous data and
+#     phase measures of the build. With '?wait', returns once the job is finished
+#
+# Paths are read by the service process, relative to its working directory. Any client can read and write files as
+# the user of the service, so it must only listen on the loopback interface or other trusted ones.
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+INPUT_DATASETS = ['hospital_events', 'urgent_care_events', 'patients_data']
+
+# Builder options with a path, made absolute by the client
+PATH_OPTIONS = ['work_dir', 'cache_dir', 'profile_report', 'cprofile_dir', 'output_dir']
+
+
+class BuildJob:
+
+    def __init__(self, job_id, input_paths, options):
+        self.job_id = job_id
+        self.input_paths = input_paths
+        self.options = options
+
+        # 'queued', 'running', 'finished' or 'failed'
+        self.status = 'queued'
+
+        self.output = io.StringIO()
+        self.error = None
+        self.results = None
+
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+
+        self.finished = threading.Event()
+
+    def to_dict(self, details=True):
+        result = {'id': self.job_id,
+                  'status': self.status,
+                  'submit_time': self.submit_time,
+                  'start_time': self.start_time,
+                  'end_time': self.end_time}
+
+        if details:
+            result.update({'input_paths': self.input_paths,
+                           'options': self.options,
+                           'output': self.output.getvalue(),
+                           'error': self.error,
+                           'results': self.results})
+
+        return result
+
+
+class BuildService:
+
+    def __init__(self, dataset_cache_entries=6):
+        import input_data
+
+        self.dataset_cache = input_data.DatasetMemoryCache(dataset_cache_entries)
+
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.job_queue = queue.Queue()
+
+    def warm_up(self):
+        # Modules of every phase and output (if installed), and stroke codes catalog, loaded before the first job
+        event_log_builder.import_modules(event_log_builder.CORE_MODULES + event_log_builder.PHASE_MODULES)
+
+        for output_modules in [['pymongo'], ['mongomock'], ['pyarrow', 'pyarrow.parquet']]:
+            try:
+                event_log_builder.import_modules(output_modules)
+            except ImportError:
+                pass
+
+        event_log_builder.load_stroke_codes(event_log_builder.stroke_codes)
+
+    def submit(self, input_paths, options):
+        # Options are checked when the job is submitted (raises BuildError)
+        args = event_log_builder.build_options(**input_paths, **options)
+        event_log_builder.check_options(args)
+
+        with self.jobs_lock:
+            job = BuildJob(len(self.jobs) + 1, input_paths, options)
+            self.jobs[job.job_id] = job
+
+        self.job_queue.put((job, args))
+
+        return job
+
+    def job(self, job_id):
+        with self.jobs_lock:
+            return self.jobs.get(job_id)
+
+    def job_list(self):
+        with self.jobs_lock:
+            return list(self.jobs.values())
+
+    def run_jobs(self):
+        # Worker thread. The standard output of the builder is the output of the job (the other threads of the
+        # service do not write to it)
+        while True:
+            job, args = self.job_queue.get()
+
+            job.status = 'running'
+            job.start_time = time.time()
+
+            try:
+                with contextlib.redirect_stdout(job.output):
+                    builder = event_log_builder.EventLogBuilder(args, self.dataset_cache).run()
+
+                job.results = builder.profiler.report(**builder.results())
+                job.status = 'finished'
+
+            except event_log_builder.BuildError as e:
+                job.error = str(e)
+                job.status = 'failed'
+
+            except Exception:
+                job.error = traceback.format_exc()
+                job.status = 'failed'
+
+            job.end_time = time.time()
+            job.finished.set()
+
+
+class BuildRequestHandler(BaseHTTPRequestHandler):
+
+    def send_document(self, status, document):
+        body = json.dumps(document, indent=2, default=str).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = [part for part in url.path.split('/') if part != '']
+
+        if path == ['jobs']:
+            self.send_document(200, [job.to_dict(details=False) for job in self.server.service.job_list()])
+            return
+
+        job = self.server.service.job(int(path[1])) if len(path) == 2 and path[0] == 'jobs' and path[1].isdigit() \
+            else None
+
+        if job is None:
+            self.send_document(404, {'error': "Not found: '" + url.path + "'"})
+            return
+
+        if 'wait' in urllib.parse.parse_qs(url.query, keep_blank_values=True):
+            job.finished.wait()
+
+        self.send_document(200, job.to_dict())
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path.rstrip('/') != '/jobs':
+            self.send_document(404, {'error': "Not found: '" + self.path + "'"})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+            missing_datasets = [dataset for dataset in INPUT_DATASETS if dataset not in request]
+            if len(missing_datasets) > 0:
+                raise ValueError("missing input datasets " + ", ".join(missing_datasets))
+
+            job = self.server.service.submit({dataset: request[dataset] for dataset in INPUT_DATASETS},
+                                             request.get('options', {}))
+
+        except event_log_builder.BuildError as e:
+            self.send_document(400, {'error': str(e)})
+            return
+
+        except (ValueError, TypeError, AttributeError) as e:
+            self.send_document(400, {'error': "Invalid job request: " + str(e)})
+            return
+
+        self.send_document(202, job.to_dict(details=False))
+
+
+def serve(host, port, dataset_cache_entries):
+    service = BuildService(dataset_cache_entries)
+    service.warm_up()
+
+    threading.Thread(target=service.run_jobs, daemon=True).start()
+
+    server = ThreadingHTTPServer((host, port), BuildRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+
+    print("Build service listening on http://" + host + ":" + str(port) + "/", flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def request_document(url, document=None):
+    # GET, or POST of the document. Errors of the service are raised as BuildError
+    data = None if document is None else json.dumps(document).encode('utf-8')
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        raise event_log_builder.BuildError(json.loads(e.read()).get('error', str(e)))
+    except urllib.error.URLError as e:
+        raise event_log_builder.BuildError("Build service not available at '" + url + "': " + str(e.reason))
+
+
+def submit_job(url, builder_arguments):
+    # Job of the builder command line arguments, with the paths made absolute. Returns the finished job
+    options = vars(event_log_builder.argument_parser().parse_args(builder_arguments))
+
+    for name in INPUT_DATASETS + PATH_OPTIONS:
+        if options[name] is not None and options[name] != '-':
+            options[name] = os.path.abspath(options[name])
+
+    request = {dataset: options.pop(dataset) for dataset in INPUT_DATASETS}
+    request['options'] = options
+
+    job = request_document(url.rstrip('/') + "/jobs", request)
+
+    return request_document(url.rstrip('/') + "/jobs/" + str(job['id']) + "?wait")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Build service of the Code Stroke log generator')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='Run the service')
+    serve_parser.add_argument('--host', type=str, default=DEFAULT_HOST,
+                              help='Address of the service (default "' + DEFAULT_HOST + '", only local clients)')
+    serve_parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                              help='Port of the service (default ' + str(DEFAULT_PORT) + ')')
+    serve_parser.add_argument('--dataset-cache-entries', type=int, default=6,
+                              help='Number of parsed input datasets kept in memory (default 6)')
+
+    submit_parser = subparsers.add_parser('submit', help='Submit a build to the service, wait for it and print its '
+                                                         'output')
+    submit_parser.add_argument('--url', type=str, default='http://' + DEFAULT_HOST + ':' + str(DEFAULT_PORT) + '/',
+                               help='URL of the service (default "http://' + DEFAULT_HOST + ':' + str(DEFAULT_PORT) +
+                                    '/")')
+    submit_parser.add_argument('builder_arguments', nargs=argparse.REMAINDER,
+                               help='Arguments of the event log builder (input datasets and options)')
+
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        if args.dataset_cache_entries < 0:
+            print("Number of dataset cache entries cannot be negative.", file=sys.stderr)
+            exit(-1)
+
+        try:
+            serve(args.host, args.port, args.dataset_cache_entries)
+        except (event_log_builder.BuildError, OSError) as e:
+            print("Error starting the build service: " + str(e), file=sys.stderr)
+            exit(-1)
+
+    else:
+        try:
+            finished_job = submit_job(args.url, args.builder_arguments)
+        except event_log_builder.BuildError as e:
+            print(str(e), file=sys.stderr)
+            exit(-1)
+
+        print(finished_job['output'], end='')
+
+        if finished_job['status'] == 'failed':
+            print(finished_job['error'], file=sys.stderr)
+            exit(-1)
@@ -0,0 +1,271 @@
+import copy
+
+import numpy as np
+import pandas as pd
+
+import episode_linking
+
+
+# Columnar episode linking engine. Events are sorted once by (patient, date, type, time) and the link predicate of
+# 'Episode.linked_events' is computed with NumPy for all the consecutive pairs of events of each patient; episodes are
+# then the runs of linked events, numbered with a cumulative sum of the episode starts.
+#
+# A linked hospitalisation is synchronized with its previous event (its admission is moved after the end of the
+# previous event, see 'HospitalEvent.synchronize_timestamps'), which changes the times the next pair is evaluated
+# with. Pairs are then resolved in waves: a pair is evaluated once the times of its previous event are final, so the
+# number of waves is bounded by the longest run of consecutive hospitalisations of a patient.
+#
+# Episodes are finally materialized as Episode objects (same state as 'episode_linking.scatter_events' leaves them)
+# from the slices of their events, so closing and output are shared by both engines. Including the events in the
+# Episode objects stays a loop, as the timestamps of the linked events are synchronized one after the other.
+# 'check_equivalence' links a copy of the events with the object engine and compares the result episode for episode.
+
+# Discharge codes of 'Episode.linked_events'
+HOSP_TO_HOSP_DISCHARGE_CODES = [2, 20, 5, 50]
+HOSP_LONG_STAY_DISCHARGE_CODES = [5, 50]
+HOSP_TO_URG_DISCHARGE_CODES = [2, 20]
+
+SECOND = np.timedelta64(1, 's')
+DAY = np.timedelta64(1, 'D')
+
+
+class LinkingMismatchError(Exception):
+    pass
+
+
+def datetime_array(values):
+    # None for missing values. Converted by pandas, faster than 'np.array' for lists of 'datetime' objects
+    return pd.to_datetime(pd.Series(values, dtype=object)).values.astype('datetime64[us]')
+
+
+def dates(datetimes):
+    return datetimes.astype('datetime64[D]')
+
+
+def second_to_last_time(event):
+    # See UrgentCareEvent.second_to_last_time (None when the event has less than two times)
+    if event.event_type != 'URG':
+        return None
+
+    times = [t for t in [event.admission_time, event.first_attention_time, event.ct_time, event.fibrinolysis_time,
+                         event.observation_room_time, event.discharge_time, event.exit_time] if t is not None]
+
+    return event.second_to_last_time() if len(times) >= 2 else None
+
+
+class SortedEvents:
+
+    # Columns of the events, sorted by (patient, date, type, time) as 'Event.sort_key' orders them (urgent care before
+    # hospitalisation on the same date). The sort is stable, so the order is the same as sorting by 'Event.sort_key'
+
+    def __init__(self, event_list):
+        start_times = datetime_array([event.start_time for event in event_list])
+        hospital = np.array([event.event_type == 'HOSP' for event in event_list], dtype=bool)
+        patients = pd.factorize(pd.Series([event.patient for event in event_list], dtype=object))[0]
+
+        order = np.lexsort((start_times, hospital, dates(start_times), patients)) if len(event_list) > 0 else \
+            np.array([], dtype=np.int64)
+
+        self.events = [event_list[i] for i in order]
+
+        self.patients = patients[order]
+        self.hospital = hospital[order]
+        self.start_times = start_times[order]
+        self.end_times = datetime_array([event.end_time for event in self.events])
+
+        # First event of each patient, that starts an episode in any case
+        self.patient_start = np.ones(len(self.events), dtype=bool)
+        self.patient_start[1:] = self.patients[1:] != self.patients[:-1]
+
+        self.surgery_times = datetime_array([event.surgery_time if event.event_type == 'HOSP' else None
+                                             for event in self.events])
+        self.second_to_last_times = datetime_array([second_to_last_time(event) for event in self.events])
+
+        # Discharge code checks of each event, as in 'Episode.linked_events'
+        discharge_codes = [event.discharge_code for event in self.events]
+        self.hosp_to_hosp_code = np.array([code in HOSP_TO_HOSP_DISCHARGE_CODES for code in discharge_codes],
+                                          dtype=bool)
+        self.long_stay_code = np.array([code in HOSP_LONG_STAY_DISCHARGE_CODES for code in discharge_codes],
+                                       dtype=bool)
+        self.hosp_to_urg_code = np.array([code in HOSP_TO_URG_DISCHARGE_CODES for code in discharge_codes],
+                                         dtype=bool)
+        self.not_code_2 = np.array([code != 2 for code in discharge_codes], dtype=bool)
+        self.not_code_6 = np.array([code != 6 for code in discharge_codes], dtype=bool)
+        self.not_code_11 = np.array([code != 11 for code in discharge_codes], dtype=bool)
+
+        # Facility of each event compared with the one of its previous event (urgent care facility of the previous
+        # event against the hospital or urgent care facility of the event). Index 0 is unused
+        facilities = [event.hospital_code if event.event_type == 'HOSP' else event.urgent_care_facility_code
+                      for event in self.events]
+        prev_facilities = [event.urgent_care_facility_code if event.event_type == 'URG' else None
+                           for event in self.events]
+        self.same_facility = np.array([False] + [prev_facility == facility for prev_facility, facility in
+                                                 zip(prev_facilities[:-1], facilities[1:])], dtype=bool)
+        self.different_facility = np.array([False] + [prev_facility != facility for prev_facility, facility in
+                                                      zip(prev_facilities[:-1], facilities[1:])], dtype=bool)
+
+
+def link_pairs(sorted_events):
+    # Link predicate of each event with its previous event of the same patient, and the bad endpoint and long stay
+    # flags set by 'Episode.linked_events'
+    n = len(sorted_events.events)
+
+    hospital = sorted_events.hospital
+
+    # Times as the previous event is seen by the next pair, after its synchronization
+    start_times = sorted_events.start_times.copy()
+    end_times = sorted_events.end_times.copy()
+
+    linked = np.zeros(n, dtype=bool)
+    bad_endpoint = np.zeros(n, dtype=bool)
+    long_stay = np.zeros(n, dtype=bool)
+
+    resolved = sorted_events.patient_start.copy()
+
+    while not resolved.all():
+        # Pairs whose previous event times are final: urgent care times never change, and hospitalisation times
+        # are final once its own pair is resolved (they only change when it links, synchronized in the same wave)
+        current = np.flatnonzero(~resolved & np.concatenate(([False], resolved[:-1] | ~hospital[:-1])))
+        prev = current - 1
+
+        prev_start_dates = dates(start_times[prev])
+        prev_end_times = end_times[prev]
+        prev_end_dates = dates(prev_end_times)
+        current_starts = start_times[current]
+        current_start_dates = dates(current_starts)
+
+        candidate = ~((prev_start_dates < current_start_dates) & (prev_end_dates > current_start_dates))
+
+        prev_hospital = hospital[prev]
+        current_hospital = hospital[current]
+
+        # HOSP -> HOSP
+        hosp_hosp = candidate & prev_hospital & current_hospital & (prev_end_dates == current_start_dates)
+        hosp_hosp_linked = hosp_hosp & sorted_events.hosp_to_hosp_code[prev]
+
+        # HOSP -> URG
+        hosp_urg_linked = candidate & prev_hospital & ~current_hospital & (prev_end_dates == current_start_dates) & \
+            sorted_events.hosp_to_urg_code[prev]
+
+        # URG -> HOSP
+        urg_hosp = candidate & ~prev_hospital & current_hospital & \
+            ((prev_end_dates == current_start_dates) | (prev_end_dates + DAY == current_start_dates) |
+             ((prev_end_dates > current_start_dates) &
+              (dates(sorted_events.second_to_last_times[prev]) == current_start_dates)))
+        urg_hosp_bad = urg_hosp & \
+            ((sorted_events.same_facility[current] & sorted_events.not_code_6[prev]) |
+             (sorted_events.different_facility[current] & sorted_events.not_code_2[prev]))
+
+        # URG -> URG
+        urg_urg = candidate & ~prev_hospital & ~current_hospital & \
+            ((prev_end_times == current_starts) |
+             ((prev_end_times + np.timedelta64(3, 'h') >= current_starts) & (current_starts > prev_end_times)))
+        urg_urg_bad = urg_urg & sorted_events.different_facility[current] & sorted_events.not_code_11[prev]
+
+        linked[current] = hosp_hosp_linked | hosp_urg_linked | (urg_hosp & ~urg_hosp_bad) | (urg_urg & ~urg_urg_bad)
+        bad_endpoint[current] = (hosp_hosp & ~sorted_events.hosp_to_hosp_code[prev]) | urg_hosp_bad | urg_urg_bad
+        long_stay[current] = hosp_hosp_linked & sorted_events.long_stay_code[prev]
+
+        # Synchronization of the linked hospitalisations, see 'HospitalEvent.synchronize_timestamps'
+        synchronized = current[linked[current] & current_hospital]
+
+        admission_times = end_times[synchronized - 1] + SECOND
+        discharge_times = sorted_events.end_times[synchronized]
+        surgery_times = sorted_events.surgery_times[synchronized]
+
+        discharge_times = np.where(dates(discharge_times) == dates(admission_times),
+                                   admission_times + SECOND, discharge_times + np.timedelta64(12, 'h'))
+
+        surgery_times = np.where(dates(surgery_times) == dates(admission_times),
+                                 admission_times + SECOND, surgery_times + np.timedelta64(12, 'h'))
+        surgery = ~np.isnat(surgery_times)
+        discharge_times = np.where(surgery & (dates(surgery_times) == dates(discharge_times)),
+                                   surgery_times + SECOND, discharge_times)
+
+        start_times[synchronized] = admission_times
+        end_times[synchronized] = discharge_times
+
+        resolved[current] = True
+
+    return linked, bad_endpoint, long_stay
+
+
+def scatter_events(patient_dict, event_list, check=False):
+    # Columnar counterpart of 'episode_linking.scatter_events'. With 'check', the result is compared with the object
+    # engine (see 'check_equivalence')
+    if check:
+        reference_patient_dict, reference_event_list = copy.deepcopy((patient_dict, event_list))
+        episode_linking.scatter_events(reference_patient_dict, reference_event_list)
+
+    # Events of missing patients are left out
+    sorted_events = SortedEvents([event for event in event_list if event.patient in patient_dict])
+
+    linked, bad_endpoint, long_stay = link_pairs(sorted_events)
+
+    # Episodes are the runs of linked events: 'episode_index' numbers the episode of each event, and the events of
+    # episode i are events[episode_starts[i]:episode_stops[i]]
+    episode_index = np.cumsum(~linked) - 1
+    episode_starts = np.flatnonzero(~linked)
+    episode_stops = np.append(episode_starts[1:], len(linked))
+
+    # A bad endpoint is found on the event that does not link, and flags the episode before
+    bad_endpoint_episodes = episode_index[bad_endpoint & ~linked] - 1
+
+    # Episodes followed by another episode of the patient are closed, as the object engine closes them when an event
+    # does not link
+    closed_episodes = np.flatnonzero(~sorted_events.patient_start[episode_starts[1:]])
+
+    events = sorted_events.events
+
+    for position in np.flatnonzero(long_stay).tolist():
+        events[position].long_stay_hospital = True
+
+    episodes = []
+
+    for start, stop in zip(episode_starts.tolist(), episode_stops.tolist()):
+        episode = episode_linking.Episode()
+        episode.include_event(events[start])
+
+        # Linked events are synchronized with their previous event in order
+        for position in range(start + 1, stop):
+            episode.include_event(events[position], events[position - 1])
+
+        episodes.append(episode)
+        patient_dict[events[start].patient].episode_list.append(episode)
+
+    for index in bad_endpoint_episodes.tolist():
+        episodes[index].bad_endpoint = True
+
+    for index in closed_episodes.tolist():
+        episodes[index].close()
+
+    if check:
+        check_equivalence(reference_patient_dict, patient_dict)
+
+
+def episode_state(episode):
+    return {'episode_id': episode.episode_id,
+            'open': episode.open,
+            'stroke': episode.stroke_episode,
+            'correct': episode.correct,
+            'incorrect_event': episode.incorrect_event,
+            'bad_endpoint': episode.bad_endpoint,
+            'left_censored': episode.left_censored,
+            'right_censored': episode.right_censored,
+            'event_list': [event.to_dict() for event in episode.event_list]}
+
+
+def check_equivalence(reference_patient_dict, patient_dict):
+    # Raises LinkingMismatchError at the first episode that differs between both engines
+    for patient_id, reference_patient in reference_patient_dict.items():
+        episode_list = patient_dict[patient_id].episode_list
+
+        if len(reference_patient.episode_list) != len(episode_list):
+            raise LinkingMismatchError("Patient '" + str(patient_id) + "': " + str(len(episode_list)) +
+                                       " episodes, " + str(len(reference_patient.episode_list)) +
+                                       " with the object linking engine")
+
+        for reference_episode, episode in zip(reference_patient.episode_list, episode_list):
+            if episode_state(reference_episode) != episode_state(episode):
+                raise LinkingMismatchError("Patient '" + str(patient_id) + "': episode " + str(episode.episode_id) +
+                                           " differs from the object linking engine")
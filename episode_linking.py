@@ -1,12 +1,15 @@
 from functools import total_ordering
+import functools
+import heapq
+from operator import attrgetter
 import abc
+import bisect
 from datetime import datetime, timedelta
 import calendar
 import pytz
 import pandas as pd
 import numpy as np
 import json
-from bson import json_util
 
 madrid_time = pytz.timezone('Europe/Madrid')
 
@@ -32,17 +35,87 @@ def madrid_datetime(datetime_var):
     return result
 
 
-class ErroneousDataAccount:
+def madrid_datetime_column(datetime_column):
+    # Whole-column counterpart of madrid_datetime, keeping the datetime64 dtype: naive wall-clock time truncated to
+    # seconds, and NaT for missing values
+    datetime_column = pd.to_datetime(pd.Series(datetime_column))
+
+    if datetime_column.dt.tz is not None:
+        datetime_column = datetime_column.dt.tz_localize(None)
+
+    return datetime_column.dt.floor('S')
+
+
+def datetime_column_values(datetime_column):
+    # 'datetime' objects (None for missing values), as madrid_datetime returns them, from a normalized column
+    result = datetime_column.dt.to_pydatetime().astype(object)
+    result[datetime_column.isna().values] = None
+
+    return result
+
+
+def timestamp_column(datetime_column):
+    # Object column of pandas Timestamps (None for missing values) from a normalized column, as the location history
+    # of the patients is stored
+    return datetime_column.astype(object).where(datetime_column.notna(), None)
+
+
+class Diagnostics:
+
+    # Erroneous data counters of a run, or of a shard of it (e.g. a worker process, see 'parallel_linking'), passed
+    # through ingestion and linking instead of being kept in global state, so concurrent or successive runs in the
+    # same interpreter do not mix their counts. Shards are merged by adding their counters. With 'sample_size', the
+    # ids of the offending events (patients for 'missing_patients') are sampled for audit, up to 'sample_size' per
+    # counter: the smallest ids are kept, so merged samples do not depend on the sharding or the merge order
+
+    COUNTERS = ['missing_patients', 'non_stroke_epidose', 'only_urg_care_no_code_stroke',
+                'urg_care_stroke_to_hosp_missing_hosp', 'hosp_surgery_out_of_bounds',
+                'urg_suspicious_timestamp_granularity', 'urg_fibr_out_of_bounds', 'missing_hospital_link',
+                'right_censored']
+
+    __slots__ = ['sample_size', 'counters', 'samples']
+
+    def __init__(self, sample_size=0):
+        self.sample_size = sample_size
+
+        self.counters = dict.fromkeys(Diagnostics.COUNTERS, 0)
+        self.samples = {name: [] for name in Diagnostics.COUNTERS}
+
+    def __getitem__(self, counter):
+        return self.counters[counter]
+
+    def record(self, counter, ids, count=None):
+        # Counts the offending 'ids', or 'count' occurrences of them (e.g. several timestamps of the same event)
+        ids = list(ids)
+
+        self.counters[counter] += len(ids) if count is None else count
+
+        if self.sample_size > 0 and len(ids) > 0:
+            self.add_sample(counter, ids)
+
+    def add_sample(self, counter, ids):
+        self.samples[counter] = heapq.nsmallest(self.sample_size, set(self.samples[counter]).union(ids))
+
+    def merge(self, other):
+        for name, value in other.counters.items():
+            self.counters[name] += value
+
+        if self.sample_size > 0:
+            for name, ids in other.samples.items():
+                if len(ids) > 0:
+                    self.add_sample(name, ids)
+
+        return self
+
+    def to_dict(self):
+        # Counters, and the samples of the counters with offending ids
+        result = dict(self.counters)
+
+        if self.sample_size > 0:
+            result['samples'] = {name: ids for name, ids in self.samples.items() if len(ids) > 0}
+
+        return result
 
-    missing_patients = 0
-    non_stroke_epidose = 0
-    only_urg_care_no_code_stroke = 0
-    urg_care_stroke_to_hosp_missing_hosp = 0
-    hosp_surgery_out_of_bounds = 0
-    urg_suspicious_timestamp_granularity = 0
-    urg_fibr_out_of_bounds = 0
-    missing_hospital_link = 0
-    right_censored = 0
 
 # Singleton taken from
 # https://python-3-patterns-idioms-test.readthedocs.io/en/latest/Singleton.html
@@ -50,22 +123,51 @@ class StrokeCodes(object):
 
     class __StrokeCodes:
         def __init__(self):
-            self.stroke_codes_df = None
+            self._stroke_codes_df = None
+
+            # Index of the stroke codes catalog, built when the catalog is assigned: 'clean_code' -> (type, subtype)
+            self.code_index = {}
+            self.code_table = None
+
+        @property
+        def stroke_codes_df(self):
+            return self._stroke_codes_df
 
+        @stroke_codes_df.setter
+        def stroke_codes_df(self, stroke_codes_df):
+            self._stroke_codes_df = stroke_codes_df
+
+            # First catalog entry prevails on duplicated clean codes
+            self.code_table = stroke_codes_df.drop_duplicates('clean_code').set_index('clean_code')[['type', 'subtype']]
+            self.code_table = self.code_table.astype(object).where(self.code_table.notnull(), None)
+
+            self.code_index = {clean_code: (stroke_type, stroke_subtype) for clean_code, stroke_type, stroke_subtype in
+                               self.code_table.itertuples(index=True, name=None)}
+
+        @staticmethod
+        def clean_code(code_to_check):
+            return str(code_to_check).replace('.', '')
 
         def get_type(self, code_to_check):
+            # (type, subtype) of the stroke code, or None if it is not a stroke code
 
             if code_to_check is None:
                 return None
             else:
-                clean_code = str(code_to_check).replace('.', '')
+                return self.code_index.get(self.clean_code(code_to_check))
+
+        def get_types(self, codes_to_check):
+            # Batch counterpart of get_type. Returns a DataFrame, aligned with the input codes, with the 'stroke' flag
+            # and the 'type' and 'subtype' of the codes (None if not a stroke code)
+            codes_to_check = pd.Series(codes_to_check)
+            clean_codes = codes_to_check.astype(str).str.replace('.', '', regex=False)
 
-                result = self.stroke_codes_df[self.stroke_codes_df['clean_code'] == clean_code]
+            result = self.code_table.reindex(clean_codes.values)
+            result = result.where(result.notnull(), None)
+            result.index = codes_to_check.index
+            result.insert(0, 'stroke', clean_codes.isin(self.code_index).values)
 
-                if result.empty:
-                    return None
-                else:
-                    return result
+            return result
 
     instance = None
 
@@ -80,6 +182,21 @@ class StrokeCodes(object):
     def __setattr__(self, name):
         return setattr(self.instance, name)
 
+# Episodes ending with an urgent care event in the last days of the study are right censored, as their follow-up
+# (e.g. a hospitalisation) may be missing
+RIGHT_CENSORING_MARGIN = timedelta(days=30)
+
+
+def study_start_time(first_day_of_study):
+    # Episodes starting before are left censored
+    return madrid_datetime(datetime.combine(first_day_of_study, datetime.min.time()))
+
+
+def study_end_time(last_day_of_study):
+    last_day_of_study_with_time = datetime.combine(last_day_of_study, datetime.min.time())
+    return madrid_datetime(last_day_of_study_with_time + timedelta(hours=23, minutes=59, seconds=59))
+
+
 # Singleton taken from
 # https://python-3-patterns-idioms-test.readthedocs.io/en/latest/Singleton.html
 class StudyData(object):
@@ -105,9 +222,22 @@ class StudyData(object):
 
 
 
+# When timestamps are on the same date, the urgent care is supposed to occur before the hospitalization
+EVENT_TYPE_RANK = {'URG': 0, 'HOSP': 1}
+
+
+# Events use '__slots__' (no per-instance '__dict__'), as millions of them are held during the linking. Documents of
+# the events are created by 'to_dict'
 @total_ordering
 class Event:
 
+    __slots__ = ['episode_id', 'event_id', 'event_type', 'patient', 'start_time', 'end_time', 'correct', 'suspicious',
+                 'sort_key']
+
+    # Fields of the event document ('sort_key' is not part of it)
+    DOCUMENT_FIELDS = ['episode_id', 'event_id', 'event_type', 'patient', 'start_time', 'end_time', 'correct',
+                       'suspicious']
+
     def __init__(self, event_id, event_type, patient, start_time, end_time):
         self.episode_id = 0
         self.event_id = event_id
@@ -118,8 +248,12 @@ class Event:
         self.correct = True
         self.suspicious = False
 
+        # Order of the events for the linking, computed once from the times before their synchronization. Within a
+        # patient, it is the same order as '__lt__'
+        self.sort_key = (patient, start_time.date(), EVENT_TYPE_RANK[event_type], start_time)
+
     @abc.abstractmethod
-    def check_correctness(self):
+    def check_correctness(self, diagnostics=None):
         pass
 
     @abc.abstractmethod
@@ -127,9 +261,16 @@ class Event:
         pass
 
     @abc.abstractmethod
-    def to_activity_dict(self):
+    def activities(self, episode_id):
+        # Generator of the activity log documents of the event
         pass
 
+    def to_activity_dict(self, episode_id):
+        return list(self.activities(episode_id))
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in Event.DOCUMENT_FIELDS}
+
     def __eq__(self, other):
         return (self.event_id == other.event_id and self.event_type == other.evt_type and
                 self.start_time == other.start_time and self.end_time == other.end_time and
@@ -152,6 +293,16 @@ class Event:
 
 class HospitalEvent(Event):
 
+    # Secondary diagnoses (d2 to d15) and their present on admission flags (poa2 to poa15) are held in tuples
+    __slots__ = ['admission_time', 'surgery_time', 'discharge_time', 'long_stay_hospital', 'stroke_event',
+                 'hospital_code', 'admission_type', 'discharge_code', 'diagnosis_code', 'poa1',
+                 'secondary_diagnoses', 'secondary_poas']
+
+    # Fields of the event document besides the Event ones. The tuples are written as the 'd2', 'poa2', ..., 'd15',
+    # 'poa15' fields
+    DOCUMENT_FIELDS = ['admission_time', 'surgery_time', 'discharge_time', 'long_stay_hospital', 'stroke_event',
+                       'hospital_code', 'admission_type', 'discharge_code', 'diagnosis_code', 'poa1']
+
     def __init__(self,
                  event_id,
                  patient,
@@ -164,16 +315,31 @@ class HospitalEvent(Event):
                  diagnosis_code,
                  poa1,
                  d2, poa2, d3, poa3, d4, poa4, d5, poa5, d6, poa6, d7, poa7, d8, poa8, d9, poa9, d10, poa10,
-                 d11, poa11, d12, poa12, d13, poa13, d14, poa14, d15, poa15):
-
-        super().__init__(event_id, 'HOSP', patient, madrid_datetime(admission_time), madrid_datetime(discharge_time))
-
-        self.admission_time = madrid_datetime(admission_time)
-        self.surgery_time = madrid_datetime(surgery_time)
-        self.discharge_time = madrid_datetime(discharge_time)
+                 d11, poa11, d12, poa12, d13, poa13, d14, poa14, d15, poa15,
+                 normalized=False,
+                 stroke_event=None,
+                 correctness=None,
+                 diagnostics=None):
+
+        # Bulk ingestion (see 'hospital_events_from_df') provides the timestamps already normalized, and the stroke
+        # code flag and correctness checks already computed for the whole column. Erroneous data found by the checks
+        # is recorded in 'diagnostics', if any
+        if not normalized:
+            admission_time = madrid_datetime(admission_time)
+            surgery_time = madrid_datetime(surgery_time)
+            discharge_time = madrid_datetime(discharge_time)
+
+        super().__init__(event_id, 'HOSP', patient, admission_time, discharge_time)
+
+        self.admission_time = admission_time
+        self.surgery_time = surgery_time
+        self.discharge_time = discharge_time
 
         self.long_stay_hospital = False
-        self.stroke_event = StrokeCodes().get_type(diagnosis_code) is not None
+
+        if stroke_event is None:
+            stroke_event = StrokeCodes().get_type(diagnosis_code) is not None
+        self.stroke_event = stroke_event
 
         self.hospital_code = hospital_code
         self.admission_type = admission_type
@@ -183,49 +349,39 @@ class HospitalEvent(Event):
         self.diagnosis_code = diagnosis_code
         self.poa1 = poa1
 
-        self.d2 = d2
-        self.poa2 = poa2
-        self.d3 = d3
-        self.poa3 = poa3
-        self.d4 = d4
-        self.poa4 = poa4
-        self.d5 = d5
-        self.poa5 = poa5
-        self.d6 = d6
-        self.poa6 = poa6
-        self.d7 = d7
-        self.poa7 = poa7
-        self.d8 = d8
-        self.poa8 = poa8
-        self.d9 = d9
-        self.poa9 = poa9
-        self.d10 = d10
-        self.poa10 = poa10
-        self.d11 = d11
-        self.poa11 = poa11
-        self.d12 = d12
-        self.poa12 = poa12
-        self.d13 = d13
-        self.poa13 = poa13
-        self.d14 = d14
-        self.poa14 = poa14
-        self.d15 = d15
-        self.poa15 = poa15
-
-        self.correct, self.suspicious = self.check_correctness()
-
-
-    def check_correctness(self):
+        self.secondary_diagnoses = (d2, d3, d4, d5, d6, d7, d8, d9, d10, d11, d12, d13, d14, d15)
+        self.secondary_poas = (poa2, poa3, poa4, poa5, poa6, poa7, poa8, poa9, poa10, poa11, poa12, poa13, poa14, poa15)
+
+        if correctness is None:
+            correctness = self.check_correctness(diagnostics)
+        self.correct, self.suspicious = correctness
+
+
+    def check_correctness(self, diagnostics=None):
         correct = True
         suspicious = False
 
         if self.surgery_time is not None and \
                 (self.surgery_time < self.admission_time or self.surgery_time > self.discharge_time):
-            ErroneousDataAccount.hosp_surgery_out_of_bounds += 1
+            if diagnostics is not None:
+                diagnostics.record('hosp_surgery_out_of_bounds', [self.event_id])
             correct = False
 
         return [correct, suspicious]
 
+    def to_dict(self):
+        result = super().to_dict()
+
+        for field in HospitalEvent.DOCUMENT_FIELDS:
+            result[field] = getattr(self, field)
+
+        # Same 'd2', 'poa2', ..., 'd15', 'poa15' fields as the input data
+        for i, (diagnosis, poa) in enumerate(zip(self.secondary_diagnoses, self.secondary_poas), start=2):
+            result['d' + str(i)] = diagnosis
+            result['poa' + str(i)] = poa
+
+        return result
+
     def synchronize_timestamps(self, prev_event=None):
 
         if prev_event is None:
@@ -273,14 +429,13 @@ class HospitalEvent(Event):
 
 
 
-    def to_activity_dict(self, episode_id):
-        result = []
+    def activities(self, episode_id):
 
         evt_prefix = ""
         if self.long_stay_hospital:
             evt_prefix = "long_stay_"
 
-        result.append(
+        yield (
             {
                 "id": episode_id,
                 "hospital_event_id": self.event_id,
@@ -293,7 +448,7 @@ class HospitalEvent(Event):
         )
 
         if self.surgery_time is not None:
-            result.append(
+            yield (
                 {
                     "id": episode_id,
                     "hospital_event_id": self.event_id,
@@ -303,7 +458,7 @@ class HospitalEvent(Event):
                 }
             )
 
-        result.append(
+        yield (
             {
                 "id": episode_id,
                 "hospital_event_id": self.event_id,
@@ -315,11 +470,18 @@ class HospitalEvent(Event):
             }
         )
 
-        return result
-
 
 class UrgentCareEvent(Event):
 
+    __slots__ = ['admission_time', 'first_attention_time', 'ct_time', 'fibrinolysis_time', 'observation_room_time',
+                 'discharge_time', 'exit_time', 'urgent_care_facility_code', 'discharge_code', 'diagnosis_code',
+                 'triage', 'code_stroke_activated', 'stroke_suspect']
+
+    # Fields of the event document besides the Event ones
+    DOCUMENT_FIELDS = ['admission_time', 'first_attention_time', 'ct_time', 'fibrinolysis_time',
+                       'observation_room_time', 'discharge_time', 'exit_time', 'urgent_care_facility_code',
+                       'discharge_code', 'diagnosis_code', 'triage', 'code_stroke_activated', 'stroke_suspect']
+
     def __init__(self,
                  event_id,
                  patient,
@@ -334,37 +496,62 @@ class UrgentCareEvent(Event):
                  discharge_code,
                  diagnosis_code,
                  triage,
-                 code_stroke_activated):
+                 code_stroke_activated,
+                 normalized=False,
+                 start_time=None,
+                 end_time=None,
+                 correctness=None,
+                 stroke_suspect=None,
+                 diagnostics=None):
+
+        # Bulk ingestion (see 'urgent_care_events_from_df') provides the timestamps already normalized and the
+        # CT/fibrinolysis times already repaired. As the repair must not alter the event bounds, the start and end
+        # times computed before the repair are provided as well
+        if not normalized:
+            admission_time = madrid_datetime(admission_time)
+            first_attention_time = madrid_datetime(first_attention_time)
+            ct_time = madrid_datetime(ct_time)
+            fibrinolysis_time = madrid_datetime(fibrinolysis_time)
+            observation_room_time = madrid_datetime(observation_room_time)
+            discharge_time = madrid_datetime(discharge_time)
+            exit_time = madrid_datetime(exit_time)
 
         # solution to avoid None times from https://stackoverflow.com/a/6254950/9664743
         # We are considering possible admission, first attention, fibrinolysis or observation as start times
         # and observation room, discharge and exit as possible end times
-        super().__init__(event_id,
-                         'URG',
-                         patient,
-                         min([t for t in [madrid_datetime(admission_time),
-                                          madrid_datetime(ct_time),
-                                          madrid_datetime(first_attention_time),
-                                          madrid_datetime(fibrinolysis_time),
-                                          madrid_datetime(observation_room_time)] if t is not None]),
-                         max([t for t in [madrid_datetime(observation_room_time),
-                                          madrid_datetime(discharge_time),
-                                          madrid_datetime(exit_time)] if t is not None]))
-
-        self.admission_time = madrid_datetime(admission_time)
-        self.first_attention_time = madrid_datetime(first_attention_time)
-        self.ct_time = madrid_datetime(ct_time)
-        self.fibrinolysis_time = madrid_datetime(fibrinolysis_time)
-        self.observation_room_time = madrid_datetime(observation_room_time)
-        self.discharge_time = madrid_datetime(discharge_time)
-        self.exit_time = madrid_datetime(exit_time)
+        if start_time is None:
+            start_time = min([t for t in [admission_time,
+                                          ct_time,
+                                          first_attention_time,
+                                          fibrinolysis_time,
+                                          observation_room_time] if t is not None])
+        if end_time is None:
+            end_time = max([t for t in [observation_room_time,
+                                        discharge_time,
+                                        exit_time] if t is not None])
+
+        super().__init__(event_id, 'URG', patient, start_time, end_time)
+
+        self.admission_time = admission_time
+        self.first_attention_time = first_attention_time
+        self.ct_time = ct_time
+        self.fibrinolysis_time = fibrinolysis_time
+        self.observation_room_time = observation_room_time
+        self.discharge_time = discharge_time
+        self.exit_time = exit_time
         self.urgent_care_facility_code = urgent_care_facility_code
         self.discharge_code = discharge_code
         self.diagnosis_code = diagnosis_code
         self.triage = triage
         self.code_stroke_activated = None if code_stroke_activated == np.nan else code_stroke_activated
-        self.correct, self.suspicious = self.check_correctness()
-        self.stroke_suspect = StrokeCodes().get_type(diagnosis_code) is not None
+
+        if correctness is None:
+            correctness = self.check_correctness(diagnostics)
+        self.correct, self.suspicious = correctness
+
+        if stroke_suspect is None:
+            stroke_suspect = StrokeCodes().get_type(diagnosis_code) is not None
+        self.stroke_suspect = stroke_suspect
 
     def second_to_last_time(self):
 
@@ -381,10 +568,12 @@ class UrgentCareEvent(Event):
         return times[-2]
 
 
-    def check_correctness(self):
+    def check_correctness(self, diagnostics=None):
         correct = True
         suspicious = False
 
+        suspicious_timestamps = 0
+
         urg_care_timestamps = [self.admission_time,
                                self.first_attention_time,
                                self.ct_time,
@@ -398,75 +587,81 @@ class UrgentCareEvent(Event):
                 minutes = time.minute
                 seconds = time.second
                 if minutes%5 == 0 and seconds == 0:
-                    ErroneousDataAccount.urg_suspicious_timestamp_granularity += 1
+                    suspicious_timestamps += 1
                     suspicious = True
 
+        if suspicious and diagnostics is not None:
+            diagnostics.record('urg_suspicious_timestamp_granularity', [self.event_id], count=suspicious_timestamps)
+
         # As CT time may have been entered manually, check for possible *year*, *month* and event *day*!
-        # mismatch
+        # mismatch. All the checks require the admission and first attention times, as in the bulk ingestion (see
+        # 'repair_manual_timestamp')
         if self.ct_time is not None:
 
-            if self.admission_time is not None:
+            if self.admission_time is not None and self.first_attention_time is not None:
 
                 if (self.ct_time.year < self.admission_time.year and
                         self.ct_time.year < self.first_attention_time.year):
                     self.ct_time = self.ct_time.replace(year=self.admission_time.year)
 
-                if self.first_attention_time is not None:
+                if ((self.ct_time.year == self.admission_time.year and
+                     self.ct_time.year == self.first_attention_time.year) and
+                        (self.ct_time.month != self.admission_time.month and
+                         self.ct_time.month != self.first_attention_time.month)):
+                    self.ct_time = self.ct_time.replace(month=self.admission_time.month)
 
-                    if ((self.ct_time.year == self.admission_time.year and
-                         self.ct_time.year == self.first_attention_time.year) and
-                            (self.ct_time.month != self.admission_time.month and
-                             self.ct_time.month != self.first_attention_time.month)):
-                        self.ct_time = self.ct_time.replace(month=self.admission_time.month)
-
-                    if ((self.ct_time.year == self.admission_time.year and
-                         self.ct_time.year == self.first_attention_time.year) and
-                            (self.ct_time.month == self.admission_time.month and
-                             self.ct_time.month == self.first_attention_time.month) and
-                            (self.ct_time.day != self.admission_time.day and
-                             self.ct_time.day != self.first_attention_time.day)):
-                        self.ct_time = self.ct_time.replace(day=self.admission_time.day)
+                if ((self.ct_time.year == self.admission_time.year and
+                     self.ct_time.year == self.first_attention_time.year) and
+                        (self.ct_time.month == self.admission_time.month and
+                         self.ct_time.month == self.first_attention_time.month) and
+                        (self.ct_time.day != self.admission_time.day and
+                         self.ct_time.day != self.first_attention_time.day)):
+                    self.ct_time = self.ct_time.replace(day=self.admission_time.day)
 
         # As fibrinolysis time may have been entered manually, check for possible *year*, *month* and event *day*!
         # mismatch
         if self.fibrinolysis_time is not None:
 
-            if self.admission_time is not None:
+            if self.admission_time is not None and self.first_attention_time is not None:
 
                 if (self.fibrinolysis_time.year < self.admission_time.year and
                         self.fibrinolysis_time.year < self.first_attention_time.year):
 
                     self.fibrinolysis_time = self.fibrinolysis_time.replace(year=self.admission_time.year)
 
-                if self.first_attention_time is not None:
-
-                    if ((self.fibrinolysis_time.year == self.admission_time.year and
-                            self.fibrinolysis_time.year == self.first_attention_time.year) and
-                            (self.fibrinolysis_time.month != self.admission_time.month and
-                                self.fibrinolysis_time.month != self.first_attention_time.month)):
+                if ((self.fibrinolysis_time.year == self.admission_time.year and
+                        self.fibrinolysis_time.year == self.first_attention_time.year) and
+                        (self.fibrinolysis_time.month != self.admission_time.month and
+                            self.fibrinolysis_time.month != self.first_attention_time.month)):
 
-                        self.fibrinolysis_time = self.fibrinolysis_time.replace(month=self.admission_time.month)
+                    self.fibrinolysis_time = self.fibrinolysis_time.replace(month=self.admission_time.month)
 
-                    if ((self.fibrinolysis_time.year == self.admission_time.year and
-                         self.fibrinolysis_time.year == self.first_attention_time.year) and
-                            (self.fibrinolysis_time.month == self.admission_time.month and
-                             self.fibrinolysis_time.month == self.first_attention_time.month) and
-                                (self.fibrinolysis_time.day != self.admission_time.day and
-                                self.fibrinolysis_time.day != self.first_attention_time.day)):
+                if ((self.fibrinolysis_time.year == self.admission_time.year and
+                     self.fibrinolysis_time.year == self.first_attention_time.year) and
+                        (self.fibrinolysis_time.month == self.admission_time.month and
+                         self.fibrinolysis_time.month == self.first_attention_time.month) and
+                            (self.fibrinolysis_time.day != self.admission_time.day and
+                            self.fibrinolysis_time.day != self.first_attention_time.day)):
 
-                        self.fibrinolysis_time = self.fibrinolysis_time.replace(day=self.admission_time.day)
+                    self.fibrinolysis_time = self.fibrinolysis_time.replace(day=self.admission_time.day)
 
         return [correct, suspicious]
 
+    def to_dict(self):
+        result = super().to_dict()
+
+        for field in UrgentCareEvent.DOCUMENT_FIELDS:
+            result[field] = getattr(self, field)
+
+        return result
+
     def synchronize_timestamps(self, prev_event=None):
         if prev_event is not None and prev_event.event_type == "HOSP":
             prev_event.sync_from_next_event(self)
 
-    def to_activity_dict(self, episode_id):
-
-        result = []
+    def activities(self, episode_id):
 
-        result.append(
+        yield (
             {
                 "id": episode_id,
                 "urgent_care_event_id": self.event_id,
@@ -479,7 +674,7 @@ class UrgentCareEvent(Event):
         )
 
         if self.first_attention_time is not None:
-            result.append(
+            yield (
                 {
                     "id": episode_id,
                     "urgent_care_event_id": self.event_id,
@@ -490,7 +685,7 @@ class UrgentCareEvent(Event):
             )
 
         if self.ct_time is not None:
-            result.append(
+            yield (
                 {
                     "id": episode_id,
                     "urgent_care_event_id": self.event_id,
@@ -501,7 +696,7 @@ class UrgentCareEvent(Event):
             )
 
         if self.fibrinolysis_time is not None:
-            result.append(
+            yield (
                 {
                     "id": episode_id,
                     "urgent_care_event_id": self.event_id,
@@ -512,7 +707,7 @@ class UrgentCareEvent(Event):
             )
 
         if self.observation_room_time is not None:
-            result.append(
+            yield (
                 {
                     "id": episode_id,
                     "urgent_care_event_id": self.event_id,
@@ -522,7 +717,7 @@ class UrgentCareEvent(Event):
                 }
             )
 
-        result.append(
+        yield (
             {
                 "id": episode_id,
                 "urgent_care_event_id": self.event_id,
@@ -535,7 +730,7 @@ class UrgentCareEvent(Event):
         )
 
         if self.exit_time is not None:
-            result.append(
+            yield (
                 {
                     "id": episode_id,
                     "urgent_care_event_id": self.event_id,
@@ -545,22 +740,78 @@ class UrgentCareEvent(Event):
                 }
             )
 
-        return result
+
+class LocationHistory:
+
+    # Location history of a patient as parallel lists (in input order) of location ids and from/to dates (None for
+    # missing values), with the intervals sorted by from date for a bisect lookup. A location is valid from its from
+    # date (included) to its to date (excluded), or indefinitely with a missing to date; when several are valid, the
+    # first in input order is used
+
+    __slots__ = ['location_ids', 'from_dts', 'to_dts', 'sorted_rows', 'sorted_from_dts', 'disjoint']
+
+    def __init__(self, location_ids, from_dts, to_dts):
+        self.location_ids = location_ids
+        self.from_dts = from_dts
+        self.to_dts = to_dts
+
+        # Locations without from date are never valid
+        self.sorted_rows = sorted((row for row in range(len(from_dts)) if from_dts[row] is not None),
+                                  key=lambda row: from_dts[row])
+        self.sorted_from_dts = [from_dts[row] for row in self.sorted_rows]
+
+        # Usually intervals do not overlap, so at most one location is valid: the last one starting before the time
+        self.disjoint = all(to_dts[row] is not None and to_dts[row] <= from_dts[next_row]
+                            for row, next_row in zip(self.sorted_rows, self.sorted_rows[1:]))
+
+    @classmethod
+    def from_df(cls, location_history_df):
+        return cls(location_history_df['location_id'].tolist(),
+                   timestamp_column(madrid_datetime_column(location_history_df['from_dt'])).tolist(),
+                   timestamp_column(madrid_datetime_column(location_history_df['to_dt'])).tolist())
+
+    def valid(self, row, reference_time):
+        return self.to_dts[row] is None or reference_time < self.to_dts[row]
+
+    def locate(self, reference_time):
+        # Location id at the reference time, or None
+        started = bisect.bisect_right(self.sorted_from_dts, reference_time)
+
+        if self.disjoint:
+            if started > 0 and self.valid(self.sorted_rows[started - 1], reference_time):
+                return self.location_ids[self.sorted_rows[started - 1]]
+            return None
+
+        valid_rows = [row for row in self.sorted_rows[:started] if self.valid(row, reference_time)]
+        return self.location_ids[min(valid_rows)] if len(valid_rows) > 0 else None
+
+    def locate_all(self, reference_times):
+        return [self.locate(reference_time) for reference_time in reference_times]
+
+    def to_dict(self):
+        return [{'location_id': location_id, 'from_dt': from_dt, 'to_dt': to_dt}
+                for location_id, from_dt, to_dt in zip(self.location_ids, self.from_dts, self.to_dts)]
 
 
 class Patient:
 
-    def __init__(self, patient_id, dob, dod, sex, location_history, gma_n_affected_systems = None, gma_weight = None):
+    def __init__(self, patient_id, dob, dod, sex, location_history, gma_n_affected_systems = None, gma_weight = None,
+                 normalized=False):
+        # 'build_patients' provides the dates already normalized for the whole patients dataset, and the location
+        # history as a LocationHistory (otherwise a data frame with 'location_id', 'from_dt' and 'to_dt' columns)
+        if not normalized:
+            dob = madrid_datetime(dob)
+            dod = madrid_datetime(dod)
+            location_history = LocationHistory.from_df(location_history)
+
         self.patient_id = patient_id
 
-        self.dob = madrid_datetime(dob)
-        self.dod = madrid_datetime(dod)
+        self.dob = dob
+        self.dod = dod
         self.sex = sex
         self.gma_n_affected_systems = gma_n_affected_systems
         self.gma_weight = gma_weight
         self.location_history = location_history
-        self.location_history[["from_dt", "to_dt"]] = \
-            self.location_history[["from_dt", "to_dt"]].applymap(madrid_datetime).replace({pd.NaT:None})
         self.episode_list = []
 
     def add_event(self, new_event: Event):
@@ -568,12 +819,7 @@ class Patient:
             self.episode_list.append(Episode())
 
         if not self.episode_list[-1].add_event(new_event):
-            # Current event did not link with previous episode event
-
-            # Update location
-            self.episode_list[-1].add_location(self.location_history)
-
-            # And start a new episode
+            # Current event did not link with previous episode event, so start a new episode
             self.episode_list.append(Episode())
             self.episode_list[-1].add_event(new_event)
 
@@ -581,30 +827,54 @@ class Patient:
         for ep in self.episode_list:
             ep.close()
 
+        self.locate_episodes()
+
+    def locate_episodes(self):
+        # Location of the episodes closed by a following episode (the last episode of the patient is not located),
+        # resolved at once for all the episode reference times
+        located_episodes = [ep for ep in self.episode_list[:-1] if ep.locatable()]
+
+        location_ids = self.location_history.locate_all([ep.reference_time() for ep in located_episodes])
+
+        for ep, location_id in zip(located_episodes, location_ids):
+            ep.set_location(location_id)
+
     def to_dict(self):
         # Here 'dict' is required to copy the dictionary of the object and avoid the overwriting done by following
         # statements
         result = dict(vars(self))
-        result['location_history'] = self.location_history.to_dict(orient='records')
+        result['location_history'] = self.location_history.to_dict()
         result['episode_list'] = [ep.to_dict() for ep in self.episode_list]
         return result
 
     def to_json(self):
+        # 'bson' (from the 'pymongo' package) is only imported here, so the builder does not require it with the
+        # Parquet output
+        from bson import json_util
+
         return json.dumps(self.to_dict(), default=json_util.default)
 
     def to_event_activity_dict(self):
         return [ep.to_event_activity_dict() for ep in self.episode_list]
 
-class Episode:
+# Episodes are identified by their first event, so episode ids do not depend on the processing order and are stable
+# across runs and partitions of the data. Hospital and urgent care event ids may overlap, so the event type is encoded
+# in the lowest bit. Ids are below 2^53 (the integer precision of R, which reads them as doubles) for event ids below
+# 2^52
+EPISODE_ID_EVENT_TYPE_BIT = {'HOSP': 0, 'URG': 1}
 
-    episode_id_seq = 0
 
-    def __init__(self):
-        Episode.episode_id_seq += 1
+def episode_id_of(first_event):
+    return int(first_event.event_id) * 2 + EPISODE_ID_EVENT_TYPE_BIT[first_event.event_type]
+
+
+class Episode:
 
+    def __init__(self):
         self.open = True
 
-        self.episode_id = Episode.episode_id_seq
+        # Set when the first event is added (see 'episode_id_of')
+        self.episode_id = None
 
         # In aragon, the ZBS
         self.location_id = 0
@@ -628,30 +898,45 @@ class Episode:
 #        print("Episode " + str(self.episode_id) + ". Adding event " + str(new_event.event_id))
 
         if len(self.event_list) == 0:
-            self.event_list.append(new_event)
-            new_event.episode_id = self.episode_id
+            self.include_event(new_event)
             event_included = True
 
         else:
             prev_event = self.event_list[-1]
             if self.linked_events(prev_event, new_event):
-                self.event_list.append(new_event)
-                new_event.episode_id = self.episode_id
+                self.include_event(new_event, prev_event)
                 event_included = True
-                new_event.synchronize_timestamps(prev_event)
 
         if not event_included:
             pass 
 #            print("Event not linked!")
 
+        if event_included is False:
+            self.close()
+#            print("Closing episode!")
+
+        return event_included
+
+    def include_event(self, new_event, prev_event=None):
+        # Adds an event linked to the previous one ('prev_event', None for the first event of the episode)
+
+        if len(self.event_list) == 0:
+            self.episode_id = episode_id_of(new_event)
+
+        self.event_list.append(new_event)
+        new_event.episode_id = self.episode_id
+
+        if prev_event is not None:
+            new_event.synchronize_timestamps(prev_event)
+
         # Check if there are hospital events in the episode, to ease the further cleanup
-        if event_included is True and new_event.event_type == 'HOSP':
+        if new_event.event_type == 'HOSP':
 
             if new_event.stroke_event:
                 self.stroke_episode = True
 
         # Check if there are urgent care events specific states, to ease the further cleanup
-        if event_included is True and new_event.event_type == 'URG':
+        if new_event.event_type == 'URG':
             if (new_event.code_stroke_activated is not None and new_event.code_stroke_activated) or \
                     new_event.stroke_suspect:
                 self.stroke_episode = True
@@ -660,15 +945,9 @@ class Episode:
             # if new_event.discharge_code == 6:
             #   self.urgent_care_to_hospital_discharges = True
 
-        if event_included is False:
-            self.close()
-#            print("Closing episode!")
-        else:
-            if not new_event.correct:
-                self.incorrect_event = True
-                self.correct = False
-
-        return event_included
+        if not new_event.correct:
+            self.incorrect_event = True
+            self.correct = False
 
     def close(self):
 
@@ -688,7 +967,7 @@ class Episode:
 
             self.correct = not self.bad_endpoint
 
-            if self.stroke_episode and self.correct:
+            if self.censorable():
                 self.censors(StudyData().first_day_of_study, StudyData().last_day_of_study)
 
         self.open = False
@@ -702,9 +981,7 @@ class Episode:
 
                 first_event = self.event_list[0]
 
-                first_day_of_study_with_time = \
-                    madrid_datetime(datetime.combine(first_day_of_study, datetime.min.time()))
-                if first_event.start_time < first_day_of_study_with_time:
+                if first_event.start_time < study_start_time(first_day_of_study):
                     self.left_censored = True
 
             if last_day_of_study is not None:
@@ -713,43 +990,36 @@ class Episode:
 
                 if not self.left_censored:
 
-                    last_day_of_study_with_time = datetime.combine(last_day_of_study, datetime.min.time())
-                    last_day_of_study_with_time = \
-                        madrid_datetime(last_day_of_study_with_time + timedelta(hours=23, minutes=59, seconds=59))
-
                     if last_event.event_type == 'URG' and \
-                            last_event.end_time > (last_day_of_study_with_time - timedelta(days=30)):
+                            last_event.end_time > (study_end_time(last_day_of_study) - RIGHT_CENSORING_MARGIN):
                         self.right_censored = True
 
+    def censorable(self):
+        # Censoring is evaluated on closing for correct stroke episodes only (see 'close')
+        return self.stroke_episode and self.correct
 
+    def censoring_times(self):
+        # Start time of the first event, and type and end time of the last event, used by 'censors'
+        if len(self.event_list) == 0:
+            return None, None, None
 
-            # if last_event.event_type == 'HOSP' and last_event.discharge_code in [2, 20, 5,  50]:
-            #     self.missing_hospital_link = True
-            #     ErroneousDataAccount.missing_hospital_link += 1
-
-            # if len(self.event_list) >= 2:
-            #     next_to_last_event = self.event_list[-2]
-            #
-            #     # if next_to_last_event.event_type == 'HOSP' and next_to_last_event.discharge_code in [5, 50]:
-            #     #     last_event.long_stay_hospital = True
-
+        return self.event_list[0].start_time, self.event_list[-1].event_type, self.event_list[-1].end_time
 
-    def add_location(self, location_history):
+    def locatable(self):
+        return self.stroke_episode and self.correct and len(self.event_list) > 0
 
-        if self.stroke_episode and self.correct:
+    def reference_time(self):
+        return self.event_list[0].start_time
 
-            if len(self.event_list) > 0:
-                reference_time = self.event_list[0].start_time
+    def set_location(self, location_id):
+        if location_id is not None:
+            # 'int' to guarantee the proper JSON serialization
+            self.location_id = int(location_id)
 
-                if len(location_history.loc[(reference_time >= location_history['from_dt']) &
-                                            ((reference_time < location_history['to_dt']) |
-                                             location_history['to_dt'].isnull())]['location_id'].values) > 0:
+    def add_location(self, location_history):
 
-                    # 'int' to guarantee the proper JSON serialization (the 'location_id' is a Pandas internal type)
-                    self.location_id = int(location_history.loc[
-                        (reference_time >= location_history['from_dt']) &
-                        ((reference_time < location_history['to_dt']) |
-                         location_history['to_dt'].isnull())]['location_id'].values[0])
+        if self.locatable():
+            self.set_location(location_history.locate(self.reference_time()))
 
 
 
@@ -767,14 +1037,16 @@ class Episode:
 
         # result = dict(vars(self))
         result = output_vars
-        result['event_list'] = [vars(evt) for evt in self.event_list]
+        result['event_list'] = [evt.to_dict() for evt in self.event_list]
         return result
 
-    def to_activity_dict(self):
-        result = []
+    def activities(self):
+        # Generator of the activity log documents of the episode, event by event
         for evt in self.event_list:
-            result = result + evt.to_activity_dict(self.episode_id)
-        return result
+            yield from evt.activities(self.episode_id)
+
+    def to_activity_dict(self):
+        return list(self.activities())
 
 
     def linked_events(self, prev_event: Event, current_event: Event):
@@ -907,3 +1179,330 @@ class Episode:
     #                 self.bad_urgent_care_link = True
     #
     #     return result
+
+
+class EpisodeStatistics:
+
+    # Episode counts of the builder STATISTICS report
+
+    def __init__(self):
+        self.total_episodes = 0
+        self.identified_episodes = 0
+        self.stroke_and_incorrect = 0
+        self.not_stroke = 0
+        self.incorrect_episodes = 0
+        self.left_censored = 0
+        self.right_censored = 0
+        self.incorrect_events = 0
+        self.bad_endpoint = 0
+
+    def add(self, episode, censoring=None):
+        # Returns whether the episode is identified, i.e. part of the activity log. 'censoring' overrides the (left,
+        # right) censoring of the episode, e.g. for another study window (see 'study_windows')
+        left_censored, right_censored = (episode.left_censored, episode.right_censored) if censoring is None else \
+            censoring
+
+        self.total_episodes += 1
+
+        if episode.stroke_episode and episode.correct and not left_censored and not right_censored:
+            self.identified_episodes += 1
+            return True
+
+        if not episode.stroke_episode:
+            self.not_stroke += 1
+
+        if not episode.correct:
+            self.incorrect_episodes += 1
+
+        if episode.stroke_episode and not episode.correct:
+            self.stroke_and_incorrect += 1
+
+        if episode.incorrect_event:
+            self.incorrect_events += 1
+
+        if episode.bad_endpoint:
+            self.bad_endpoint += 1
+
+        if left_censored:
+            self.left_censored += 1
+
+        if right_censored:
+            self.right_censored += 1
+
+        return False
+
+
+def patient_row_slices(patients_df):
+    # Partition of the patients data in a single pass: a copy sorted by patient (stable, so the rows of each patient
+    # keep their order) and the slice of the rows of each patient in it
+    sorted_patients_df = patients_df.sort_values('patient_id', kind='mergesort')
+
+    sorted_ids = sorted_patients_df['patient_id'].values
+    boundaries = (np.flatnonzero(sorted_ids[1:] != sorted_ids[:-1]) + 1).tolist()
+
+    starts = [0] + boundaries
+    stops = boundaries + [len(sorted_ids)]
+
+    patient_rows = {sorted_ids[start]: slice(start, stop) for start, stop in zip(starts, stops) if start < stop}
+
+    return sorted_patients_df, patient_rows
+
+
+def build_patients(patient_ids, patients_df, diagnostics=None):
+    # Patient objects of the given patient ids. Patients without data are accounted as missing in 'diagnostics', if
+    # any
+    patient_dict = {}
+
+    # Patients data is partitioned once, instead of filtering the whole dataset for every patient
+    sorted_patients_df, patient_rows = patient_row_slices(patients_df)
+
+    # Dates are normalized once per column
+    dobs = datetime_column_values(madrid_datetime_column(sorted_patients_df['dob']))
+    dods = datetime_column_values(madrid_datetime_column(sorted_patients_df['dod']))
+
+    location_ids = sorted_patients_df['location_id'].tolist()
+    from_dts = timestamp_column(madrid_datetime_column(sorted_patients_df['from_dt'])).tolist()
+    to_dts = timestamp_column(madrid_datetime_column(sorted_patients_df['to_dt'])).tolist()
+
+    sexes = sorted_patients_df['sex'].values
+
+    for current_patient_id in patient_ids:
+
+        if current_patient_id in patient_rows:
+
+            rows = patient_rows[current_patient_id]
+
+            patient_dict[current_patient_id] = Patient(current_patient_id,
+                                                       dobs[rows.start],
+                                                       dods[rows.start],
+                                                       sexes[rows.start],
+                                                       LocationHistory(location_ids[rows], from_dts[rows],
+                                                                       to_dts[rows]),
+                                                       normalized=True)
+        elif diagnostics is not None:
+            diagnostics.record('missing_patients', [current_patient_id])
+
+    return patient_dict
+
+
+def scatter_events(patient_dict, event_list):
+    # Events are linked into episodes in chronological order (see 'Event.sort_key'). Events are grouped by patient
+    # first, so only the events of each patient are sorted. Events of missing patients are left out
+    patient_events = {}
+
+    for current_event in event_list:
+        if current_event.patient in patient_dict:
+            patient_events.setdefault(current_event.patient, []).append(current_event)
+
+    for patient_id, current_patient_events in patient_events.items():
+        current_patient_events.sort(key=attrgetter('sort_key'))
+
+        patient = patient_dict[patient_id]
+        for current_event in current_patient_events:
+            patient.add_event(current_event)
+
+
+# Row ingestion. Events are created row by row from the input datasets. Erroneous data is recorded in 'diagnostics',
+# if any
+
+def hospital_events_from_rows(hospital_df, diagnostics=None):
+    event_list = []
+
+    for index, row in hospital_df.iterrows():
+        new_event = \
+            HospitalEvent(row['event_id'],
+                          row['patient_id'],
+                          row['admission_time'],
+                          row['surgery_time'],
+                          row['discharge_time'],
+                          row['hospital_code'],
+                          row['admission_type'],
+                          row['discharge_code'],
+                          # row['discharge_service_code'],
+                          row['diagnosis_code'],
+                          row['poa1'],
+                          row['d2'],row['poa2'],row['d3'],row['poa3'],row['d4'],row['poa4'],
+                          row['d5'],row['poa5'],row['d6'],row['poa6'],row['d7'],row['poa7'],
+                          row['d8'],row['poa8'],row['d9'],row['poa9'],row['d10'],row['poa10'],
+                          row['d11'],row['poa11'],row['d12'],row['poa12'],row['d13'],row['poa13'],
+                          row['d14'],row['poa14'],row['d15'],row['poa15'],
+                          diagnostics=diagnostics)
+
+        event_list.append(new_event)
+
+    return event_list
+
+
+def urgent_care_events_from_rows(urgent_care_df, diagnostics=None):
+    event_list = []
+
+    for index, row in urgent_care_df.iterrows():
+        new_event = UrgentCareEvent(row['event_id'],
+                                    row['patient_id'],
+                                    row['admission_time'],
+                                    row['first_attention_time'],
+                                    row['ct_time'],
+                                    row['fibrinolysis_time'],
+                                    row['observation_room_time'],
+                                    row['discharge_time'],
+                                    row['exit_time'],
+                                    row['urgent_care_facility_code'],
+                                    row['discharge_code'],
+                                    row['diagnosis_code'],
+                                    row['triage'],
+                                    row['code_stroke_activated'],
+                                    diagnostics=diagnostics)
+
+        event_list.append(new_event)
+
+    return event_list
+
+
+# Bulk ingestion. Timestamp normalization, stroke code flagging and correctness checks are computed as whole-column
+# operations, and the events are then created in batch from the column values. Resulting events (and the diagnostics
+# counters) are the same as creating the events row by row.
+
+HOSPITAL_EVENT_COLUMNS = ['event_id', 'patient_id', 'admission_time', 'surgery_time', 'discharge_time',
+                          'hospital_code', 'admission_type', 'discharge_code', 'diagnosis_code', 'poa1'] + \
+                         [column for i in range(2, 16) for column in ['d' + str(i), 'poa' + str(i)]]
+
+URGENT_CARE_EVENT_COLUMNS = ['event_id', 'patient_id', 'admission_time', 'first_attention_time', 'ct_time',
+                             'fibrinolysis_time', 'observation_room_time', 'discharge_time', 'exit_time',
+                             'urgent_care_facility_code', 'discharge_code', 'diagnosis_code', 'triage',
+                             'code_stroke_activated']
+
+URGENT_CARE_TIMESTAMPS = ['admission_time', 'first_attention_time', 'ct_time', 'fibrinolysis_time',
+                          'observation_room_time', 'discharge_time', 'exit_time']
+
+
+def hospital_events_from_df(hospital_df, diagnostics=None):
+
+    times = {column: madrid_datetime_column(hospital_df[column])
+             for column in ['admission_time', 'surgery_time', 'discharge_time']}
+
+    # See HospitalEvent.check_correctness
+    surgery_out_of_bounds = times['surgery_time'].notna() & \
+        ((times['surgery_time'] < times['admission_time']) | (times['surgery_time'] > times['discharge_time']))
+    if diagnostics is not None:
+        diagnostics.record('hosp_surgery_out_of_bounds', hospital_df['event_id'][surgery_out_of_bounds.values].tolist())
+
+    correctness = [(not out_of_bounds, False) for out_of_bounds in surgery_out_of_bounds.tolist()]
+    stroke_events = StrokeCodes().get_types(hospital_df['diagnosis_code'])['stroke'].tolist()
+
+    columns = [datetime_column_values(times[column]) if column in times else hospital_df[column].tolist()
+               for column in HOSPITAL_EVENT_COLUMNS]
+
+    return [HospitalEvent(*values, normalized=True, stroke_event=stroke_event, correctness=event_correctness)
+            for values, stroke_event, event_correctness in zip(zip(*columns), stroke_events, correctness)]
+
+
+def datetime_parts(times):
+    # Year, month (1-12), day (1-31) and time of the day of a datetime64 array (undefined for missing times)
+    years = times.astype('datetime64[Y]')
+    months = times.astype('datetime64[M]')
+    days = times.astype('datetime64[D]')
+
+    return years.astype(np.int64) + 1970, (months - years).astype(np.int64) + 1, (days - months).astype(np.int64) + 1, \
+        times - days
+
+
+def replace_dates(times, mask, year=None, month=None, day=None):
+    # Column-wise 'datetime.replace' of the year, month or day (arrays aligned with 'times') of the masked times.
+    # Raises ValueError if a replaced date does not exist (e.g. February 29 in a non-leap year), as 'replace' does
+    if not mask.any():
+        return times
+
+    masked_years, masked_months, masked_days, masked_time_of_day = datetime_parts(times[mask])
+
+    if year is not None:
+        masked_years = year[mask]
+    if month is not None:
+        masked_months = month[mask]
+    if day is not None:
+        masked_days = day[mask]
+
+    month_starts = ((masked_years - 1970) * 12 + masked_months - 1).astype('datetime64[M]')
+    dates = month_starts.astype('datetime64[D]') + (masked_days - 1)
+
+    if (dates.astype('datetime64[M]') != month_starts).any():
+        raise ValueError("day is out of range for month")
+
+    result = times.copy()
+    result[mask] = dates + masked_time_of_day
+
+    return result
+
+
+def repair_manual_timestamp(manual_time, admission_time, first_attention_time):
+    # Column-wise year, month and day repair of a manually entered timestamp, over datetime64 arrays (NaT for missing
+    # values). See UrgentCareEvent.check_correctness: each repair sees the previous ones, and all of them require the
+    # three timestamps
+    known = ~np.isnat(manual_time) & ~np.isnat(admission_time) & ~np.isnat(first_attention_time)
+
+    admission_year, admission_month, admission_day, _ = datetime_parts(admission_time)
+    first_attention_year, first_attention_month, first_attention_day, _ = datetime_parts(first_attention_time)
+
+    year, _, _, _ = datetime_parts(manual_time)
+    year_mismatch = known & (year < admission_year) & (year < first_attention_year)
+    manual_time = replace_dates(manual_time, year_mismatch, year=admission_year)
+
+    year, month, _, _ = datetime_parts(manual_time)
+    same_year = known & (year == admission_year) & (year == first_attention_year)
+    month_mismatch = same_year & (month != admission_month) & (month != first_attention_month)
+    manual_time = replace_dates(manual_time, month_mismatch, month=admission_month)
+
+    year, month, day, _ = datetime_parts(manual_time)
+    same_month = known & (year == admission_year) & (year == first_attention_year) & \
+        (month == admission_month) & (month == first_attention_month)
+    day_mismatch = same_month & (day != admission_day) & (day != first_attention_day)
+    manual_time = replace_dates(manual_time, day_mismatch, day=admission_day)
+
+    return manual_time
+
+
+def suspicious_granularity(times):
+    # Times with a multiple of 5 minutes and no seconds (see UrgentCareEvent.check_correctness), i.e. whole multiples
+    # of 5 minutes since the epoch, as normalized times have no fraction of a second
+    return ~np.isnat(times) & (times.astype('datetime64[s]').astype(np.int64) % 300 == 0)
+
+
+def datetime_values(times):
+    # 'datetime' objects (None for missing values), as madrid_datetime returns them, from a datetime64 array
+    return datetime_column_values(pd.Series(times))
+
+
+def urgent_care_events_from_df(urgent_care_df, diagnostics=None):
+
+    times = {column: madrid_datetime_column(urgent_care_df[column]).values for column in URGENT_CARE_TIMESTAMPS}
+
+    # Event bounds are computed before the CT and fibrinolysis repair, as in the UrgentCareEvent constructor
+    start_times = functools.reduce(np.fmin, [times['admission_time'], times['ct_time'], times['first_attention_time'],
+                                             times['fibrinolysis_time'], times['observation_room_time']])
+    end_times = functools.reduce(np.fmax, [times['observation_room_time'], times['discharge_time'],
+                                           times['exit_time']])
+
+    # See UrgentCareEvent.check_correctness
+    suspicious = np.stack([suspicious_granularity(t) for t in times.values()])
+    event_suspicious = suspicious.any(axis=0)
+
+    if diagnostics is not None:
+        diagnostics.record('urg_suspicious_timestamp_granularity',
+                           urgent_care_df['event_id'][event_suspicious].tolist(), count=int(suspicious.sum()))
+
+    correctness = [(True, is_suspicious) for is_suspicious in event_suspicious.tolist()]
+
+    times['ct_time'] = repair_manual_timestamp(times['ct_time'],
+                                               times['admission_time'], times['first_attention_time'])
+    times['fibrinolysis_time'] = repair_manual_timestamp(times['fibrinolysis_time'],
+                                                         times['admission_time'], times['first_attention_time'])
+
+    stroke_suspects = StrokeCodes().get_types(urgent_care_df['diagnosis_code'])['stroke'].tolist()
+
+    columns = [datetime_values(times[column]) if column in times else urgent_care_df[column].tolist()
+               for column in URGENT_CARE_EVENT_COLUMNS]
+
+    return [UrgentCareEvent(*values, normalized=True, start_time=start_time, end_time=end_time,
+                            correctness=event_correctness, stroke_suspect=stroke_suspect)
+            for values, start_time, end_time, event_correctness, stroke_suspect in
+            zip(zip(*columns), datetime_values(start_times), datetime_values(end_times),
+                correctness, stroke_suspects)]
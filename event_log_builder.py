@@ -1,331 +1,775 @@
-import episode_linking
+import output_sinks
+import phase_profiler
+import study_windows
+import importlib
 import os
 import sys
-import argparse
-import pymongo
 import time
+import argparse
 from datetime import datetime
-import pandas as pd
-import numpy as np
-from tabulate import tabulate
 
-patient_dict = {}
-patient_ids = set()
-
-event_list = []
+# Event log builder, as a command line script and as a library: 'build_event_log' runs a build with the same options
+# as the command line, and raises a 'BuildError' instead of exiting. Builds use the StrokeCodes and StudyData
+# singletons, so a process runs one build at a time (see 'build_service' for a long-lived process running builds as
+# jobs).
+#
+# Options and input files are checked before the linking modules (and pandas, NumPy and the output clients) are
+# imported, in the 'Module imports' phase of the build. Modules of optional phases are only imported when selected,
+# and modules use function-level imports of them.
 
 # Check input files availability
 stroke_codes = 'data/stroke_codes.csv'
-hospital_events = ''
-urgent_care_events = ''
-patients_data = ''
 
-parser = argparse.ArgumentParser(description='Code Stroke log generator from RWD datasets')
-parser.add_argument('hospital_events', type=str, help='Hospital events data file')
-parser.add_argument('urgent_care_events', type=str, help='Urgent Care events data file')
-parser.add_argument('patients_data', type=str, help='Patients information data file')
+# Modules of every build, third-party modules first, so the import time of each builder module does not include them
+CORE_MODULES = ['numpy', 'pandas', 'pytz', 'input_data', 'episode_linking', 'activity_aggregates', 'incremental_build']
+
+# Modules of the optional phases
+PHASE_MODULES = ['columnar_linking', 'parallel_linking', 'streaming_ingestion']
+
+
+class BuildError(Exception):
+    pass
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Code Stroke log generator from RWD datasets')
+    parser.add_argument('hospital_events', type=str, help='Hospital events data file')
+    parser.add_argument('urgent_care_events', type=str, help='Urgent Care events data file')
+    parser.add_argument('patients_data', type=str, help='Patients information data file')
+    parser.add_argument('--study-window', type=str, nargs=2, action='append', metavar=('FIRST_DAY', 'LAST_DAY'),
+                        help='Study window (YYYY-MM-DD days, default 2017-01-01 2017-12-31), used for the episode '
+                             'censoring. It can be given several times: episodes are linked once, and the activity log '
+                             'and statistics of every additional window are written as well')
+    parser.add_argument('--ingestion', type=str, choices=['bulk', 'row'], default='bulk',
+                        help='Event creation from the input datasets: whole-column operations ("bulk", default) or '
+                             'row by row ("row")')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of worker processes for the episode linking (default 1, linking in the builder '
+                             'process). Patients are sharded across the processes by a hash of the patient id')
+    parser.add_argument('--linking', type=str, choices=['object', 'columnar'], default='object',
+                        help='Episode linking engine: event by event ("object", default) or with NumPy over the sorted '
+                             'events of all the patients ("columnar")')
+    parser.add_argument('--check-linking', action='store_true',
+                        help='Check that the columnar linking engine links every episode as the object engine (slow)')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Stream inputs larger than the available memory: input datasets are read in chunks and '
+                             'partitioned on disk by patient, and partitions are linked and written one at a time')
+    parser.add_argument('--partitions', type=int, default=64,
+                        help='Number of patient partitions of the streaming mode (default 64)')
+    parser.add_argument('--chunk-size', type=int, default=100000,
+                        help='Number of input rows read at once in the streaming mode (default 100000)')
+    parser.add_argument('--work-dir', type=str, default=None,
+                        help='Directory of the temporary partition files of the streaming mode (default: system '
+                             'temporary directory)')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory of a cache of the parsed input datasets, so unchanged inputs are not parsed '
+                             'again in later runs (default: no cache). Not used in streaming mode')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Incremental rebuild of the MongoDB output: only the patients whose input data changed '
+                             'since the previous incremental run are linked and written again')
+    parser.add_argument('--profile-report', type=str, default=None,
+                        help='JSON report of the wall time, CPU time, peak memory and rows per second of each phase '
+                             '("-" prints it after the statistics)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Record the peak of the Python allocations of each phase in the profile report (slower)')
+    parser.add_argument('--cprofile-dir', type=str, default=None,
+                        help='Directory of a cProfile stats file per phase')
+    parser.add_argument('--profile-imports', action='store_true',
+                        help='Print the import time of each module imported by the build after the statistics (they '
+                             'are included in the profile report as well)')
+    parser.add_argument('--no-aggregates', action='store_true',
+                        help='Do not write the activity log aggregates of the dashboard (directly-follows edges, trace '
+                             'variants and resource counts)')
+    parser.add_argument('--aggregate-coverage', type=float, default=0.95,
+                        help='Share of the episodes covered by the most frequent trace variants of the filtered '
+                             'directly-follows edges aggregate (default 0.95)')
+    parser.add_argument('--diagnostics-sample', type=int, default=0,
+                        help='Number of ids of the offending events (or patients) sampled for each erroneous data '
+                             'counter, printed after the statistics (default 0, no sampling)')
+    parser.add_argument('--output', type=str, choices=['mongodb', 'parquet'], default='mongodb',
+                        help='Output of the event log, patients and activity log collections: a MongoDB database '
+                             '("mongodb", default) or Parquet files ("parquet", requires the "pyarrow" package)')
+    parser.add_argument('--mongo-uri', type=str, default='mongodb://localhost:27017/',
+                        help='MongoDB connection URI (default "mongodb://localhost:27017/"). Use "mongomock://" for an '
+                             'in-memory stand-in of the server (requires the "mongomock" package)')
+    parser.add_argument('--output-dir', type=str, default='output',
+                        help='Directory of the Parquet output (default "output")')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='Number of documents written per output batch (default 1000 for MongoDB insertions, '
+                             '100000 for Parquet files)')
+
+    return parser
+
+
+def build_options(hospital_events, urgent_care_events, patients_data, **options):
+    # Options of a build as parsed from the command line: defaults of the command line options, replaced by the given
+    # ones, named as their attributes (e.g. output='parquet', study_window=[('2016-01-01', '2016-12-31')])
+    args = argument_parser().parse_args(['--', str(hospital_events), str(urgent_care_events), str(patients_data)])
+
+    for name, value in options.items():
+        if name in ['hospital_events', 'urgent_care_events', 'patients_data'] or not hasattr(args, name):
+            raise BuildError("Unknown build option '" + name + "'.")
+
+        setattr(args, name, value)
+
+    return args
+
+
+def check_options(args):
+    # Returns the study windows of the build
+    try:
+        study_window_list = [study_windows.StudyWindow(datetime(2017, 1, 1), datetime(2017, 12, 31))] \
+            if args.study_window is None else \
+            [study_windows.StudyWindow.parse(first_day, last_day) for first_day, last_day in args.study_window]
+    except ValueError as e:
+        raise BuildError("Invalid study window: " + str(e))
+
+    if args.processes < 1:
+        raise BuildError("Number of processes must be a positive number.")
+
+    if args.partitions < 1 or args.chunk_size < 1:
+        raise BuildError("Number of partitions and chunk size must be positive numbers.")
+
+    if args.streaming and args.processes > 1:
+        raise BuildError("Streaming mode links one partition at a time, it cannot be used with multiple processes.")
+
+    if args.incremental and (args.output != 'mongodb' or args.streaming):
+        raise BuildError("Incremental rebuild requires the MongoDB output, and cannot be used in streaming mode.")
+
+    if args.incremental and len(study_window_list) > 1:
+        raise BuildError("Incremental rebuild cannot be used with several study windows.")
+
+    if args.check_linking and args.linking != 'columnar':
+        raise BuildError("Linking check requires the columnar linking engine.")
+
+    if not 0 < args.aggregate_coverage <= 1:
+        raise BuildError("Aggregate coverage must be greater than 0 and at most 1.")
+
+    if args.diagnostics_sample < 0:
+        raise BuildError("Diagnostics sample size cannot be negative.")
+
+    if args.batch_size is not None and args.batch_size < 1:
+        raise BuildError("Batch size must be a positive number.")
+
+    input_files = [stroke_codes, args.hospital_events, args.urgent_care_events, args.patients_data]
+
+    for infile in input_files:
+        if not os.path.isfile(infile):
+            raise BuildError("Input file '" + infile + "' not found. Please check the inputs directory.")
 
-args = parser.parse_args()
+    return study_window_list
 
-hospital_events=args.hospital_events
-urgent_care_events=args.urgent_care_events
-patients_data=args.patients_data
 
-StudyDataSingleton = episode_linking.StudyData()
-StudyDataSingleton.first_day_of_study=datetime(2017, 1, 1)
-StudyDataSingleton.last_day_of_study=datetime(2017, 12, 31)
+def import_modules(names):
+    # Imports the modules not imported yet, in order. Returns the import time (secs.) of each one, without the
+    # modules imported before
+    import_times = {}
 
-input_files = [stroke_codes, hospital_events, urgent_care_events, patients_data]
+    for name in names:
+        if name not in sys.modules:
+            start_time = time.perf_counter()
+            importlib.import_module(name)
+            import_times[name] = time.perf_counter() - start_time
 
-for infile in input_files:
-    if not os.path.isfile(infile):
-        print ("Input file '"+infile+"' not found. Please check the inputs directory.", file=sys.stderr)
-        exit(-1)
+    return import_times
 
 
-print("---------------------------------------------------")
-print("TIMING (secs.)")
-print("---------------------------------------------------")
-
-# Stroke codes
-start_time = time.time()
-
-try:
-
-    def to_bool(x):
-        result = None
-        if x is not None:
-            if x == 'S':
-                result = True
-            elif x == 'N':
-                result = False
-        return result
-
-    stroke_codes_df = pd.read_csv(stroke_codes, sep=";")
-
-    StrokeCodesSingleton = episode_linking.StrokeCodes()
-    StrokeCodesSingleton.stroke_codes_df = stroke_codes_df
-
-except Exception as e:
-    print("Error processing '" + stroke_codes+ "' " + str(e), file=sys.stderr)
-    exit(-1)
-
-stroke_codes_load_time = time.time() - start_time
-print("Stroke codes load time = " + str(stroke_codes_load_time))
-
-# Hospital events
-start_time = time.time()
-
-try:
-    hospital_df = pd.read_csv(hospital_events,
-                              parse_dates=['admission_time', 'surgery_time', 'discharge_time'],
-                              infer_datetime_format=True)
-
-except Exception as e:
-    print("Error processing '" + hospital_events + "' " + str(e), file=sys.stderr)
-    exit(-1)
-
-for index, row in hospital_df.iterrows():
-    new_event = \
-        episode_linking.HospitalEvent(row['event_id'],
-                                      row['patient_id'],
-                                      row['admission_time'],
-                                      row['surgery_time'],
-                                      row['discharge_time'],
-                                      row['hospital_code'],
-                                      row['admission_type'],
-                                      row['discharge_code'],
-                                      # row['discharge_service_code'],
-                                      row['diagnosis_code'],
-                                      row['poa1'],
-                                      row['d2'],row['poa2'],row['d3'],row['poa3'],row['d4'],row['poa4'],
-                                      row['d5'],row['poa5'],row['d6'],row['poa6'],row['d7'],row['poa7'],
-                                      row['d8'],row['poa8'],row['d9'],row['poa9'],row['d10'],row['poa10'],
-                                      row['d11'],row['poa11'],row['d12'],row['poa12'],row['d13'],row['poa13'],
-                                      row['d14'],row['poa14'],row['d15'],row['poa15'])
-
-    event_list.append(new_event)
-    patient_ids.add(row['patient_id'])
-
-hosp_events_fetch_time = time.time() - start_time
-print("Hospitalisations load time = " +str(hosp_events_fetch_time))
-
-# Urgent events
-start_time = time.time()
-
-try:
-
-    def to_bool(x):
-        result = None
-        if x is not None:
-            if x == 'S':
-                result = True
-            elif x == 'N':
-                result = False
-        return result
-
-    urgent_care_df = pd.read_csv(urgent_care_events,
-                                 parse_dates=['admission_time',
-                                              'first_attention_time',
-                                              'ct_time',
-                                              'fibrinolysis_time',
-                                              'observation_room_time',
-                                              'discharge_time',
-                                              'exit_time'],
-                                 infer_datetime_format=True,
-                                 converters={'code_stroke_activated': to_bool})
-except Exception as e:
-    print("Error processing '" + urgent_care_events+ "' " + str(e))
-    exit(-1)
-
-
-# print(tabulate(urgent_care_df.head(20), headers=urgent_care_df.columns, tablefmt='psql'))
-#
-# print("Number of SUH registers loaded in the dataframe = " + str(len(urgent_care_df)))
-# exit(0)
+# Stroke codes catalog loaded in the StrokeCodes singleton (path, size and modification time of the file), so
+# successive builds of the same process do not load it again
+loaded_stroke_codes = None
+
+
+def load_stroke_codes(path):
+    global loaded_stroke_codes
+
+    import episode_linking
+    import input_data
+
+    try:
+        stat = os.stat(path)
+        stroke_codes_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+        if stroke_codes_key != loaded_stroke_codes:
+            StrokeCodesSingleton = episode_linking.StrokeCodes()
+            StrokeCodesSingleton.stroke_codes_df = input_data.read_stroke_codes(path)
+
+            loaded_stroke_codes = stroke_codes_key
+
+    except Exception as e:
+        raise BuildError("Error processing '" + path + "' " + str(e))
+
+    return episode_linking.StrokeCodes().stroke_codes_df
 
-for index, row in urgent_care_df.iterrows():
-    new_event = episode_linking.UrgentCareEvent(row['event_id'],
-                                                row['patient_id'],
-                                                row['admission_time'],
-                                                row['first_attention_time'],
-                                                row['ct_time'],
-                                                row['fibrinolysis_time'],
-                                                row['observation_room_time'],
-                                                row['discharge_time'],
-                                                row['exit_time'],
-                                                row['urgent_care_facility_code'],
-                                                row['discharge_code'],
-                                                row['diagnosis_code'],
-                                                row['triage'],
-                                                row['code_stroke_activated'])
 
-    event_list.append(new_event)
-    patient_ids.add(row['patient_id'])
+def print_statistics(statistics):
+    print("|---> Total episodes processed = " + str(statistics.total_episodes))
+    print("|---> Identified episodes = " + str(statistics.identified_episodes))
+    print("|")
+    print("|---> Non-stroke episodes = " + str(statistics.not_stroke))
+    print("|---> Stroke episodes and incorrect = " + str(statistics.stroke_and_incorrect))
+    print("|")
+    print("|---> Incorrect episodes = " + str(statistics.incorrect_episodes))
+    print("| |--> Incorrect events = " + str(statistics.incorrect_events))
+    print("| |--> Bad endpoint = " + str(statistics.bad_endpoint))
+    print("|")
+    print("|---> Left censored = " + str(statistics.left_censored))
+    print("|---> Right censored = " + str(statistics.right_censored))
 
 
-urg_events_fetch_time = time.time() - start_time
-print("Urgent care load time = " + str(urg_events_fetch_time))
+def print_throughput(output_sink):
+    for collection_name, (inserted_documents, insertion_time, documents_per_sec) in output_sink.throughput().items():
+        print(output_sink.name + " '" + collection_name + "' throughput = " + str(inserted_documents) + " docs. in " +
+              str(insertion_time) + " secs. (" + str(documents_per_sec) + " docs./sec.)")
 
-# Scatter events per patient
-start_time = time.time()
 
-try:
-    patients_df = pd.read_csv(patients_data, parse_dates=['dob', 'dod', 'from_dt', 'to_dt'], infer_datetime_format=True)
+class EventLogBuilder:
 
-except Exception as e:
-    print("Error processing '" + patients_data + "' " + str(e), file=sys.stderr)
-    exit(-1)
+    # A single build. 'dataset_cache' is an optional 'input_data.DatasetMemoryCache' of the parsed input datasets,
+    # shared by the builds of a long-lived process
 
-for current_patient_id in patient_ids:
+    def __init__(self, args, dataset_cache=None):
+        self.args = args
+        self.dataset_cache = dataset_cache
 
-    current_patient_data = patients_df.loc[patients_df['patient_id'] == current_patient_id, :]
+        study_window_list = check_options(args)
 
-    if len(current_patient_data) > 0:
+        self.first_day_of_study = study_window_list[0].first_day
+        self.last_day_of_study = study_window_list[0].last_day
 
+        # Episodes are linked and censored in the first window, and censored again in the additional ones
+        self.additional_windows = study_window_list[1:]
 
-        patient_dict[current_patient_id] = episode_linking.Patient(current_patient_id,
-                                                                current_patient_data['dob'].iloc[0],
-                                                                current_patient_data['dod'].iloc[0],
-                                                                current_patient_data['sex'].iloc[0],
-                                                                current_patient_data.loc[:, ['location_id', 'from_dt', 'to_dt']])
-    else:
-        episode_linking.ErroneousDataAccount.missing_patients += 1
+        self.profiler = None
+        self.import_times = {}
 
+        # Statistics, erroneous data counters and aggregates of the run, created once their modules are imported
+        self.statistics = None
+        self.diagnostics = None
+        self.aggregator = None
+        self.window_statistics = {}
+        self.window_aggregators = {}
 
-for current_event in sorted(event_list):
-    if current_event.patient in patient_dict:
-        patient_dict[current_event.patient].add_event(current_event)
+        self.output_sink = None
 
-patient_event_scatter_time = time.time() - start_time
-print("Patient event scatter time = " + str(patient_event_scatter_time))
+    def required_modules(self):
+        # Modules of the selected phases and output
+        modules = list(CORE_MODULES)
 
-# Close episodes
-start_time = time.time()
-for patient_id, patient in patient_dict.items():
-    patient.close_episodes()
-episode_close_time = time.time() - start_time
-print("Episode closing time = " + str(episode_close_time))
+        if self.args.linking == 'columnar':
+            modules.append('columnar_linking')
 
-# Mongo raw event load
-start_time = time.time()
+        if self.args.processes > 1:
+            modules.append('parallel_linking')
 
-# Snapshot-time not required 
-# snapshot_time = datetime.now().strftime("%Y%m%d_%H%M")
-snapshot_time = ""
+        if self.args.streaming:
+            modules.append('streaming_ingestion')
 
-mongo_client = pymongo.MongoClient("mongodb://localhost:27017/")
-mongo_db     = mongo_client["stroke_"+snapshot_time]
+        if self.args.output == 'parquet':
+            modules += ['pyarrow', 'pyarrow.parquet']
+        elif self.args.mongo_uri.startswith(output_sinks.MONGOMOCK_URI_PREFIX):
+            modules.append('mongomock')
+        else:
+            modules.append('pymongo')
 
-if "event_log" in mongo_db.list_collection_names():
-    mongo_db["event_log"].drop()
+        return modules
 
-mongo_log_collection = mongo_db["event_log"]
+    def import_modules(self):
+        try:
+            self.import_times = import_modules(self.required_modules())
+        except ImportError as e:
+            if self.args.output == 'parquet' and e.name is not None and e.name.startswith('pyarrow'):
+                raise BuildError("Parquet output requires the 'pyarrow' package: " + str(e))
+            raise BuildError("Error importing the modules of the build: " + str(e))
 
-for x in event_list:
-    mongo_log_collection.insert_one(vars(x))
+        import activity_aggregates
+        import episode_linking
 
-mongo_raw_event_insertion_time = time.time() - start_time
-print("MongoDB raw events insertion time = " + str(mongo_raw_event_insertion_time))
+        self.statistics = episode_linking.EpisodeStatistics()
 
+        # Erroneous data counters of the run
+        self.diagnostics = episode_linking.Diagnostics(self.args.diagnostics_sample)
 
-# Mongo patient and event action log insertion
-start_time = time.time()
+        # Activity log aggregates. In incremental mode they are computed from the whole activity log once it is written
+        self.aggregator = None if self.args.no_aggregates or self.args.incremental else \
+            activity_aggregates.ActivityAggregator(self.args.aggregate_coverage)
 
-if "patients" in mongo_db.list_collection_names():
-    mongo_db["patients"].drop()
+        self.window_statistics = {window.name(): episode_linking.EpisodeStatistics()
+                                  for window in self.additional_windows}
+        self.window_aggregators = {} if self.args.no_aggregates else \
+            {window.name(): activity_aggregates.ActivityAggregator(self.args.aggregate_coverage)
+             for window in self.additional_windows}
 
-if "activity_log" in mongo_db.list_collection_names():
-    mongo_db["activity_log"].drop()
+    def create_output_sink(self):
+        if self.args.output == 'mongodb':
+            # Snapshot-time not required
+            # snapshot_time = datetime.now().strftime("%Y%m%d_%H%M")
+            snapshot_time = ""
 
-mongo_patients_collection = mongo_db["patients"]
-mongo_event_actions = mongo_db["activity_log"]
+            mongo_client = output_sinks.mongo_client(self.args.mongo_uri)
+            mongo_db     = mongo_client["stroke_"+snapshot_time]
 
-total_episodes = 0
-identified_episodes = 0
-stroke_and_incorrect = 0
-not_stroke = 0
-incorrect_episodes = 0
-left_censored = 0
-right_censored = 0
-incorrect_events = 0
-bad_endpoint = 0
+            return output_sinks.MongoSink(mongo_db, batch_size=self.args.batch_size)
+        else:
+            try:
+                return output_sinks.ParquetSink(self.args.output_dir, batch_size=self.args.batch_size,
+                                                partition_by={"event_log": "event_type"})
+            except ImportError as e:
+                raise BuildError("Parquet output requires the 'pyarrow' package: " + str(e))
+
+    def output_collections(self):
+        import activity_aggregates
+        import incremental_build
+
+        # Fingerprints of a previous incremental rebuild are no longer valid after a full build, and aggregates of a
+        # previous build are removed even if they are not written
+        collections = ["event_log", "patients", "activity_log"] + activity_aggregates.AGGREGATE_COLLECTIONS + \
+            [window.collection_name(collection_name) for window in self.additional_windows
+             for collection_name in ["activity_log"] + activity_aggregates.AGGREGATE_COLLECTIONS]
+
+        if self.args.output == 'mongodb':
+            return collections + [incremental_build.FINGERPRINTS_COLLECTION]
+        else:
+            return collections
+
+    def read_dataset(self, dataset, path):
+        import input_data
+
+        try:
+            if self.dataset_cache is not None:
+                return self.dataset_cache.read(dataset, path, self.args.cache_dir)[0]
+            elif self.args.cache_dir is None:
+                return input_data.read_dataset(dataset, path)
+            else:
+                return input_data.read_cached_dataset(dataset, path, self.args.cache_dir)[0]
+        except Exception as e:
+            raise BuildError("Error processing '" + path + "' " + str(e))
+
+    def hospital_events_from_df(self, hospital_df):
+        import episode_linking
+
+        if self.args.ingestion == 'bulk':
+            return episode_linking.hospital_events_from_df(hospital_df, self.diagnostics)
+        else:
+            return episode_linking.hospital_events_from_rows(hospital_df, self.diagnostics)
 
-for patient_id, patient in patient_dict.items():
-    mongo_patients_collection.insert_one(patient.to_dict())
+    def urgent_care_events_from_df(self, urgent_care_df):
+        import episode_linking
 
-    # A single patient may have multiple episodes, so get each episode and insert the list
-    for episode in patient.episode_list:
-        total_episodes += 1
+        if self.args.ingestion == 'bulk':
+            return episode_linking.urgent_care_events_from_df(urgent_care_df, self.diagnostics)
+        else:
+            return episode_linking.urgent_care_events_from_rows(urgent_care_df, self.diagnostics)
+
+    def scatter_events(self, patient_dict, event_list):
+        if self.args.linking == 'columnar':
+            import columnar_linking
 
-        if episode.stroke_episode and episode.correct and not episode.left_censored and not episode.right_censored:
-            identified_episodes +=1
-            mongo_event_actions.insert_many(episode.to_activity_dict())
+            try:
+                columnar_linking.scatter_events(patient_dict, event_list, check=self.args.check_linking)
+            except columnar_linking.LinkingMismatchError as e:
+                raise BuildError("Linking check failed: " + str(e))
         else:
+            import episode_linking
 
-            if not episode.stroke_episode:
-                not_stroke += 1
-
-            if not episode.correct:
-                incorrect_episodes += 1
-
-            if episode.stroke_episode and not episode.correct:
-                stroke_and_incorrect += 1
-
-            if episode.incorrect_event:
-                incorrect_events += 1
-
-            if episode.bad_endpoint:
-                bad_endpoint += 1
-
-            if episode.left_censored:
-                left_censored += 1
-
-            if episode.right_censored:
-                right_censored += 1
-
-
-mongo_patients_insertion_time = time.time() - start_time
-print("MongoDB patients insertion time = " + str(mongo_patients_insertion_time))
-
-print("")
-print("---------------------------------------------------")
-print("STATISTICS")
-print("---------------------------------------------------")
-print("|---> Total episodes processed = " + str(total_episodes))
-print("|---> Identified episodes = " + str(identified_episodes))
-print("|")
-print("|---> Non-stroke episodes = " + str(not_stroke))
-print("|---> Stroke episodes and incorrect = " + str(stroke_and_incorrect))
-print("|")
-print("|---> Incorrect episodes = " + str(incorrect_episodes))
-print("| |--> Incorrect events = " + str(incorrect_events))
-print("| |--> Bad endpoint = " + str(bad_endpoint))
-print("|")
-print("|---> Left censored = " + str(left_censored))
-print("|---> Right censored = " + str(right_censored))
-print("")
-print("")
-print("|---> Urgent care suspicious timestamp granularity = " + str(episode_linking.ErroneousDataAccount.urg_suspicious_timestamp_granularity))
-print("|---> Missing patients = " + str(episode_linking.ErroneousDataAccount.missing_patients))
-
-# with open("ictusnet_stats_"+snapshot_time+".csv", "w") as f:
-#     f.write("episodes_processed," + str(total_episodes)+ "\n")
-#     f.write("episodes_identified," + str(identified_episodes)+ "\n")
-#     f.write("incorrect_episodes," + str(incorrect_events)+ "\n")
-#     f.write("only_urgent_care_events_without_code_stroke," +
-#                  str(episode_linking.ErroneousDataAccount.only_urg_care_no_code_stroke)+ "\n")
-#     f.write("missing_hospital_event_on_urgent_care_events_to_hospital_discharge," + str(
-#         episode_linking.ErroneousDataAccount.urg_care_stroke_to_hosp_missing_hosp)+ "\n")
-#     f.write("hospital_surgery_out_of_bounds," +
-#                  str(episode_linking.ErroneousDataAccount.hosp_surgery_out_of_bounds)+ "\n")
-#     f.write("urgent_care_fibrinolysis_out_of_bounds," +
-#                  str(episode_linking.ErroneousDataAccount.urg_fibr_out_of_bounds)+ "\n")
-#     f.write("right_cen," + str(right_censored_or_missing_long_stay)+ "\n")
-#     f.write("right_censored_episodes," + str(episode_linking.ErroneousDataAccount.right_censored)+ "\n")
-#     f.write("missing_long_stay_hospital_episodes," +
-#                  str(episode_linking.ErroneousDataAccount.missing_long_stay_hospital)+ "\n")
-#     f.write("urgent_care_suspicious_timestamp_granularity," + str(
-#         episode_linking.ErroneousDataAccount.urg_suspicious_timestamp_granularity)+ "\n")
-#     f.write("missing_patients," + str(episode_linking.ErroneousDataAccount.missing_patients)+ "\n")
-#
+            episode_linking.scatter_events(patient_dict, event_list)
+
+    def write_activity_log(self, collection_name, episode, aggregator=None):
+        if aggregator is None:
+            self.output_sink.insert_many(collection_name, episode.activities())
+        else:
+            activity_documents = episode.to_activity_dict()
+            aggregator.add_episode(activity_documents)
+
+            self.output_sink.insert_many(collection_name, activity_documents)
+
+    def write_patients(self, patient_dict):
+        for patient_id, patient in patient_dict.items():
+            self.output_sink.insert("patients", patient.to_dict())
+
+            # A single patient may have multiple episodes, so get each episode and insert the list
+            for episode in patient.episode_list:
+                if self.statistics.add(episode):
+                    self.write_activity_log("activity_log", episode, self.aggregator)
+
+        if len(self.additional_windows) > 0:
+            self.write_study_windows(patient_dict)
+
+    def write_study_windows(self, patient_dict):
+        # Activity log of the additional study windows, from the episodes linked in the first one
+        episodes = [episode for patient in patient_dict.values() for episode in patient.episode_list]
+
+        episode_censoring = study_windows.EpisodeCensoring(episodes)
+
+        for window in self.additional_windows:
+            left_censored, right_censored = episode_censoring.censor(window)
+
+            for episode, censoring in zip(episodes, zip(left_censored.tolist(), right_censored.tolist())):
+                if self.window_statistics[window.name()].add(episode, censoring):
+                    self.write_activity_log(window.collection_name("activity_log"), episode,
+                                            self.window_aggregators.get(window.name()))
+
+    def run(self):
+        args = self.args
+
+        self.profiler = phase_profiler.PhaseProfiler(trace_memory=args.trace_memory, cprofile_dir=args.cprofile_dir)
+
+        try:
+            print("---------------------------------------------------")
+            print("TIMING (secs.)")
+            print("---------------------------------------------------")
+
+            # Modules of the build
+            self.profiler.start("Module imports")
+
+            self.import_modules()
+
+            module_imports_time = self.profiler.stop(rows=len(self.import_times)).wall_time
+            print("Module imports time = " + str(module_imports_time))
+
+            import episode_linking
+
+            StudyDataSingleton = episode_linking.StudyData()
+            StudyDataSingleton.first_day_of_study = self.first_day_of_study
+            StudyDataSingleton.last_day_of_study = self.last_day_of_study
+
+            # Stroke codes
+            self.profiler.start("Stroke codes load")
+
+            self.stroke_codes_df = load_stroke_codes(stroke_codes)
+
+            stroke_codes_load_time = self.profiler.stop(rows=len(self.stroke_codes_df)).wall_time
+            print("Stroke codes load time = " + str(stroke_codes_load_time))
+
+            if args.streaming:
+                self.run_streaming()
+            else:
+                self.run_in_memory()
+
+            if not args.no_aggregates:
+                self.write_aggregates()
+
+            self.print_report()
+
+        finally:
+            self.profiler.close()
+
+        return self
+
+    def run_streaming(self):
+        import episode_linking
+        import streaming_ingestion
+
+        args = self.args
+
+        # Input partitioning
+        self.profiler.start("Input partitioning")
+
+        partitioned_inputs = streaming_ingestion.PartitionedInputs({'hospital_events': args.hospital_events,
+                                                                    'urgent_care_events': args.urgent_care_events,
+                                                                    'patients_data': args.patients_data},
+                                                                   args.partitions,
+                                                                   args.chunk_size,
+                                                                   args.work_dir)
+
+        try:
+            partitioned_inputs.partition()
+        except Exception as e:
+            partitioned_inputs.cleanup()
+            raise BuildError("Error partitioning the input datasets: " + str(e))
+
+        input_partitioning_time = self.profiler.stop().wall_time
+        print("Input partitioning time (" + str(args.partitions) + " partitions) = " + str(input_partitioning_time))
+
+        # Partitions are linked and written one at a time
+        self.profiler.start("Partitions processing")
+
+        processed_events = 0
+
+        self.output_sink = self.create_output_sink()
+
+        for collection_name in self.output_collections():
+            self.output_sink.reset_collection(collection_name)
+
+        try:
+            for partition_data in partitioned_inputs.partitions():
+
+                event_list = self.hospital_events_from_df(partition_data['hospital_events']) + \
+                    self.urgent_care_events_from_df(partition_data['urgent_care_events'])
+
+                patient_dict = episode_linking.build_patients(set(event.patient for event in event_list),
+                                                              partition_data['patients_data'],
+                                                              self.diagnostics)
+
+                self.scatter_events(patient_dict, event_list)
+
+                for patient_id, patient in patient_dict.items():
+                    patient.close_episodes()
+
+                self.output_sink.insert_many("event_log", (x.to_dict() for x in event_list))
+                processed_events += len(event_list)
+
+                self.write_patients(patient_dict)
+
+        finally:
+            partitioned_inputs.cleanup()
+
+        self.output_sink.close()
+
+        partitions_processing_time = self.profiler.stop(rows=processed_events).wall_time
+        print("Partitions processing time = " + str(partitions_processing_time))
+
+        print_throughput(self.output_sink)
+
+    def run_in_memory(self):
+        import episode_linking
+        import incremental_build
+
+        args = self.args
+        profiler = self.profiler
+
+        # Hospital events
+        profiler.start("Hospitalisations load")
+
+        hospital_df = self.read_dataset('hospital_events', args.hospital_events)
+
+        event_list = self.hospital_events_from_df(hospital_df)
+        patient_ids = set(hospital_df['patient_id'].tolist())
+
+        hosp_events_fetch_time = profiler.stop(rows=len(hospital_df)).wall_time
+        print("Hospitalisations load time = " +str(hosp_events_fetch_time))
+
+        # Urgent events
+        profiler.start("Urgent care load")
+
+        urgent_care_df = self.read_dataset('urgent_care_events', args.urgent_care_events)
+
+        event_list.extend(self.urgent_care_events_from_df(urgent_care_df))
+        patient_ids.update(urgent_care_df['patient_id'].tolist())
+
+        urg_events_fetch_time = profiler.stop(rows=len(urgent_care_df)).wall_time
+        print("Urgent care load time = " + str(urg_events_fetch_time))
+
+        # Patients data
+        profiler.start("Patients data load")
+
+        patients_df = self.read_dataset('patients_data', args.patients_data)
+
+        patients_data_load_time = profiler.stop(rows=len(patients_df)).wall_time
+        print("Patients data load time = " + str(patients_data_load_time))
+
+        if args.incremental:
+            profiler.start("Incremental rebuild planning")
+
+            self.output_sink = self.create_output_sink()
+
+            key = incremental_build.build_key(self.stroke_codes_df, self.first_day_of_study, self.last_day_of_study)
+
+            fingerprints = incremental_build.patient_fingerprints(patient_ids,
+                                                                  [('hospital_events', hospital_df),
+                                                                   ('urgent_care_events', urgent_care_df),
+                                                                   ('patients_data', patients_df)],
+                                                                  key)
+
+            previous_fingerprints = incremental_build.stored_fingerprints(self.output_sink)
+
+            rebuilt_patients, removed_patients = incremental_build.changed_patients(fingerprints,
+                                                                                    previous_fingerprints)
+
+            if len(previous_fingerprints) == 0:
+                # First incremental run: documents of a previous full build (if any) have no fingerprints
+                for collection_name in self.output_collections():
+                    self.output_sink.reset_collection(collection_name)
+            else:
+                incremental_build.delete_patients(self.output_sink, rebuilt_patients | removed_patients)
+
+            # Only new and changed patients are linked and written
+            patient_ids = rebuilt_patients
+            event_list = [event for event in event_list if event.patient in rebuilt_patients]
+
+            incremental_planning_time = profiler.stop(rows=len(fingerprints)).wall_time
+            print("Incremental rebuild planning time = " + str(incremental_planning_time) + " (" +
+                  str(len(rebuilt_patients)) + " new or changed, " + str(len(removed_patients)) + " removed, " +
+                  str(len(fingerprints) - len(rebuilt_patients)) + " unchanged patients)")
+
+        # Scatter events per patient
+        if args.processes > 1:
+            profiler.start("Parallel episode linking")
+
+            import parallel_linking
+
+            # Linking check failures of the columnar engine in the workers. The engine is not imported otherwise
+            if args.linking == 'columnar':
+                import columnar_linking
+
+                linking_errors = (columnar_linking.LinkingMismatchError,)
+            else:
+                linking_errors = ()
+
+            # Scatter, linking, closing and activity log generation in worker processes
+            try:
+                patient_dict, event_documents = parallel_linking.link_in_parallel(event_list,
+                                                                                  patients_df,
+                                                                                  args.processes,
+                                                                                  self.first_day_of_study,
+                                                                                  self.last_day_of_study,
+                                                                                  args.linking,
+                                                                                  args.check_linking,
+                                                                                  self.diagnostics)
+            except linking_errors as e:
+                raise BuildError("Linking check failed: " + str(e))
+
+            parallel_linking_time = profiler.stop(rows=len(event_list)).wall_time
+            print("Parallel episode linking time (" + str(args.processes) + " processes) = " +
+                  str(parallel_linking_time))
+
+        else:
+            profiler.start("Patient event scatter")
+
+            patient_dict = episode_linking.build_patients(patient_ids, patients_df, self.diagnostics)
+
+            self.scatter_events(patient_dict, event_list)
+
+            patient_event_scatter_time = profiler.stop(rows=len(event_list)).wall_time
+            print("Patient event scatter time = " + str(patient_event_scatter_time))
+
+            # Close episodes
+            profiler.start("Episode closing")
+            for patient_id, patient in patient_dict.items():
+                patient.close_episodes()
+            episode_close_time = profiler.stop(rows=len(patient_dict)).wall_time
+            print("Episode closing time = " + str(episode_close_time))
+
+            event_documents = (x.to_dict() for x in event_list)
+
+        # Raw event output
+        profiler.start("Raw events insertion")
+
+        if not args.incremental:
+            self.output_sink = self.create_output_sink()
+
+            self.output_sink.reset_collection("event_log")
+
+        self.output_sink.insert_many("event_log", event_documents)
+        self.output_sink.flush("event_log")
+
+        raw_event_insertion_time = profiler.stop(rows=len(event_list)).wall_time
+        print(self.output_sink.name + " raw events insertion time = " + str(raw_event_insertion_time))
+
+        # Patient and event action log output
+        profiler.start("Patients insertion")
+
+        if args.incremental:
+            incremental_build.write_fingerprints(self.output_sink, fingerprints, rebuilt_patients)
+        else:
+            for collection_name in self.output_collections()[1:]:
+                self.output_sink.reset_collection(collection_name)
+
+        self.write_patients(patient_dict)
+
+        self.output_sink.close()
+
+        patients_insertion_time = profiler.stop(rows=len(patient_dict)).wall_time
+        print(self.output_sink.name + " patients insertion time = " + str(patients_insertion_time))
+
+        print_throughput(self.output_sink)
+
+    def write_aggregates(self):
+        import activity_aggregates
+
+        self.profiler.start("Activity log aggregation")
+
+        if self.args.incremental:
+            self.aggregator = activity_aggregates.ActivityAggregator(self.args.aggregate_coverage)
+            self.aggregator.add_activity_log(self.output_sink.find_documents(
+                "activity_log", projection=activity_aggregates.ACTIVITY_FIELDS))
+
+        aggregate_documents = 0
+
+        for collection_name, documents in self.aggregator.aggregates().items():
+            self.output_sink.reset_collection(collection_name)
+            self.output_sink.insert_many(collection_name, documents)
+            aggregate_documents += len(documents)
+
+        for window in self.additional_windows:
+            for collection_name, documents in self.window_aggregators[window.name()].aggregates().items():
+                self.output_sink.reset_collection(window.collection_name(collection_name))
+                self.output_sink.insert_many(window.collection_name(collection_name), documents)
+                aggregate_documents += len(documents)
+
+        self.output_sink.close()
+
+        activity_log_aggregation_time = self.profiler.stop(rows=aggregate_documents).wall_time
+        print(self.output_sink.name + " activity log aggregation time = " + str(activity_log_aggregation_time) +
+              " (" + str(aggregate_documents) + " docs.)")
+
+    def results(self):
+        # Statistics, erroneous data and module import times of the build (JSON serializable)
+        return {'statistics': vars(self.statistics),
+                'window_statistics': {str(window): vars(self.window_statistics[window.name()])
+                                      for window in self.additional_windows},
+                'erroneous_data': self.diagnostics.to_dict(),
+                'imports': self.import_times}
+
+    def print_report(self):
+        print("")
+        print("---------------------------------------------------")
+        # Incremental rebuilds only link the new and changed patients, and the statistics and erroneous data counters
+        # are those of these patients
+        print("STATISTICS (rebuilt patients only)" if self.args.incremental else "STATISTICS")
+        print("---------------------------------------------------")
+        print_statistics(self.statistics)
+        print("")
+        print("")
+        print("|---> Urgent care suspicious timestamp granularity = " +
+              str(self.diagnostics['urg_suspicious_timestamp_granularity']))
+        print("|---> Missing patients = " + str(self.diagnostics['missing_patients']))
+
+        if self.args.diagnostics_sample > 0:
+            print("")
+            for counter, ids in self.diagnostics.samples.items():
+                if len(ids) > 0:
+                    print("|---> Sample of " + counter + " = " + ", ".join(str(offending_id) for offending_id in ids))
+
+        for window in self.additional_windows:
+            print("")
+            print("---------------------------------------------------")
+            print("STATISTICS (" + str(window) + ")")
+            print("---------------------------------------------------")
+            print_statistics(self.window_statistics[window.name()])
+
+        if self.args.profile_imports:
+            print("")
+            print("---------------------------------------------------")
+            print("IMPORTS (secs.)")
+            print("---------------------------------------------------")
+            for name, import_time in self.import_times.items():
+                print("|---> " + name + " = " + str(import_time))
+            print("|")
+            print("|---> Total = " + str(sum(self.import_times.values())))
+
+        if self.args.profile_report is not None:
+            if self.args.profile_report == '-':
+                print("")
+                print("---------------------------------------------------")
+                print("PROFILE")
+                print("---------------------------------------------------")
+
+            self.profiler.write_report(self.args.profile_report, arguments=vars(self.args), **self.results())
+
+
+def build_event_log(hospital_events, urgent_care_events, patients_data, dataset_cache=None, **options):
+    # Builds the event log of the input datasets with the given options (see 'build_options'). Returns the finished
+    # EventLogBuilder, with the statistics, erroneous data and phases of the build
+    return EventLogBuilder(build_options(hospital_events, urgent_care_events, patients_data, **options),
+                           dataset_cache).run()
+
+
+if __name__ == '__main__':
+
+    args = argument_parser().parse_args()
+
+    try:
+        EventLogBuilder(args).run()
+    except BuildError as e:
+        print(str(e), file=sys.stderr)
+        exit(-1)
@@ -0,0 +1,72 @@
+import hashlib
+
+import pandas as pd
+
+import episode_linking
+
+
+# Incremental (delta) rebuild of the MongoDB output. Each patient with events is fingerprinted with a content hash of
+# its input rows (hospital events, urgent care events and patient data), stored in the 'input_fingerprints'
+# collection. On the next run only the patients whose fingerprint changed (or that are new) are linked and written
+# again, after deleting their previous documents; patients no longer in the inputs are deleted. Episode ids are derived
+# from the first event of each episode (see 'episode_linking.episode_id_of'), so the documents of unchanged patients
+# remain valid.
+
+FINGERPRINTS_COLLECTION = 'input_fingerprints'
+
+
+def build_key(stroke_codes_df, first_day_of_study, last_day_of_study):
+    # Inputs shared by all the patients, so a change in the stroke codes or the study window rebuilds every patient
+    digest = hashlib.sha1(pd.util.hash_pandas_object(stroke_codes_df, index=False).values.tobytes())
+    digest.update((str(first_day_of_study) + "|" + str(last_day_of_study)).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def patient_fingerprints(patient_ids, datasets, key):
+    # 'datasets' is a list of (name, data frame) pairs with a 'patient_id' column. Rows are hashed as parsed (values
+    # and types), keeping their order within each patient
+    digests = {patient_id: hashlib.sha1(key.encode('utf-8')) for patient_id in patient_ids}
+
+    for name, dataset_df in datasets:
+        sorted_df, patient_rows = episode_linking.patient_row_slices(dataset_df)
+        row_hashes = pd.util.hash_pandas_object(sorted_df, index=False).values
+
+        for patient_id, digest in digests.items():
+            digest.update(name.encode('utf-8'))
+            if patient_id in patient_rows:
+                digest.update(row_hashes[patient_rows[patient_id]].tobytes())
+
+    return {patient_id: digest.hexdigest() for patient_id, digest in digests.items()}
+
+
+def stored_fingerprints(mongo_sink):
+    return {document['patient_id']: document['input_hash'] for document in
+            mongo_sink.find_documents(FINGERPRINTS_COLLECTION, projection={'_id': 0, 'patient_id': 1, 'input_hash': 1})}
+
+
+def changed_patients(fingerprints, previous_fingerprints):
+    # Patients to link and write again (new or changed) and patients to delete (no longer in the inputs)
+    rebuilt_patients = set(patient_id for patient_id, input_hash in fingerprints.items()
+                           if previous_fingerprints.get(patient_id) != input_hash)
+    removed_patients = set(previous_fingerprints) - set(fingerprints)
+
+    return rebuilt_patients, removed_patients
+
+
+def delete_patients(mongo_sink, patient_ids):
+    # Activity log documents are identified by episode, so the episodes of the patients are read first
+    episode_ids = [episode['episode_id']
+                   for document in mongo_sink.find_documents('patients', 'patient_id', patient_ids,
+                                                             projection={'_id': 0, 'episode_list.episode_id': 1})
+                   for episode in document.get('episode_list', [])]
+
+    mongo_sink.delete_documents('activity_log', 'id', episode_ids)
+    mongo_sink.delete_documents('event_log', 'patient', patient_ids)
+    mongo_sink.delete_documents('patients', 'patient_id', patient_ids)
+    mongo_sink.delete_documents(FINGERPRINTS_COLLECTION, 'patient_id', patient_ids)
+
+
+def write_fingerprints(mongo_sink, fingerprints, patient_ids):
+    mongo_sink.insert_many(FINGERPRINTS_COLLECTION, [{'patient_id': patient_id, 'input_hash': fingerprints[patient_id]}
+                                                     for patient_id in patient_ids])
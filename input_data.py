@@ -0,0 +1,146 @@
+import collections
+import hashlib
+import os
+import tempfile
+import zlib
+
+import pandas as pd
+
+
+def to_bool(x):
+    result = None
+    if x is not None:
+        if x == 'S':
+            result = True
+        elif x == 'N':
+            result = False
+    return result
+
+
+# 'pd.read_csv' options of each input dataset
+DATASET_READ_OPTIONS = {
+    'hospital_events': {
+        'parse_dates': ['admission_time', 'surgery_time', 'discharge_time']
+    },
+    'urgent_care_events': {
+        'parse_dates': ['admission_time', 'first_attention_time', 'ct_time', 'fibrinolysis_time',
+                        'observation_room_time', 'discharge_time', 'exit_time'],
+        'converters': {'code_stroke_activated': to_bool}
+    },
+    'patients_data': {
+        'parse_dates': ['dob', 'dod', 'from_dt', 'to_dt']
+    }
+}
+
+
+def read_stroke_codes(stroke_codes):
+    return pd.read_csv(stroke_codes, sep=";")
+
+
+def read_dataset(dataset, path, **options):
+    # Additional 'pd.read_csv' options (e.g. 'dtype') can be provided
+    return pd.read_csv(path, infer_datetime_format=True, **DATASET_READ_OPTIONS[dataset], **options)
+
+
+def patient_shard(patient_id, n_shards):
+    # Shard of the patient, used to split the input rows by patient (parallel linking and streaming partitions).
+    # Stable across processes and runs, unlike the built-in 'hash' of strings
+    return zlib.crc32(str(patient_id).encode('utf-8')) % n_shards
+
+
+# Cache of the parsed input datasets. Entries are keyed by the dataset, the file path, size, modification time and
+# content hash, and the pandas version, so any change of the input file (or of the parsing) misses the cache. Data
+# frames are stored as pickles, which keep the parsed column types exactly (e.g. columns mixing numeric and text
+# diagnosis codes, not supported by Parquet or Feather). Only cache directories written by the builder must be used,
+# as pickles are not safe to load from untrusted sources
+CACHE_VERSION = 1
+
+
+def file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def cache_entry_prefix(dataset, path):
+    # Entries of the same input file share the prefix, so a new entry replaces the outdated ones
+    return dataset + "_" + hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:16] + "_"
+
+
+def cache_key(dataset, path):
+    stat = os.stat(path)
+
+    key = "|".join([str(CACHE_VERSION), pd.__version__, dataset, os.path.abspath(path), str(stat.st_size),
+                    str(stat.st_mtime_ns), file_digest(path)])
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def read_cached_dataset(dataset, path, cache_dir):
+    # Returns the data frame and whether it was read from the cache
+    prefix = cache_entry_prefix(dataset, path)
+    entry_path = os.path.join(cache_dir, prefix + cache_key(dataset, path) + ".pkl")
+
+    if os.path.isfile(entry_path):
+        return pd.read_pickle(entry_path), True
+
+    dataset_df = read_dataset(dataset, path)
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Written to a temporary file first, so an interrupted run does not leave a truncated entry
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix=".tmp_", suffix=".pkl")
+    os.close(fd)
+    try:
+        dataset_df.to_pickle(temp_path)
+        os.replace(temp_path, entry_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    for file_name in os.listdir(cache_dir):
+        if file_name.startswith(prefix) and os.path.join(cache_dir, file_name) != entry_path:
+            os.remove(os.path.join(cache_dir, file_name))
+
+    return dataset_df, False
+
+
+class DatasetMemoryCache:
+
+    # Parsed input datasets kept in memory by a long-lived process (see 'build_service'), with the keys of the cache
+    # directory entries, so a changed input file is parsed again. An input file has a single entry, and the least
+    # recently used files are dropped beyond 'max_entries'. Data frames are shared by the builds, which do not modify
+    # them
+
+    def __init__(self, max_entries=6):
+        self.max_entries = max_entries
+
+        # Entry prefix (dataset and file path) -> (key, data frame)
+        self.entries = collections.OrderedDict()
+
+    def read(self, dataset, path, cache_dir=None):
+        # Returns the data frame and whether it was in memory. Missing entries are read through the cache directory,
+        # if any
+        prefix = cache_entry_prefix(dataset, path)
+        key = cache_key(dataset, path)
+
+        if prefix in self.entries and self.entries[prefix][0] == key:
+            self.entries.move_to_end(prefix)
+            return self.entries[prefix][1], True
+
+        if cache_dir is None:
+            dataset_df = read_dataset(dataset, path)
+        else:
+            dataset_df = read_cached_dataset(dataset, path, cache_dir)[0]
+
+        self.entries[prefix] = (key, dataset_df)
+        self.entries.move_to_end(prefix)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        return dataset_df, False
@@ -0,0 +1,251 @@
+import abc
+import json
+import os
+import shutil
+import time
+
+MONGOMOCK_URI_PREFIX = 'mongomock://'
+
+
+def mongo_client(mongo_uri):
+    # 'mongomock://' URIs use an in-memory stand-in of the MongoDB server (requires the 'mongomock' package), so
+    # the builder can be run and checked without a MongoDB instance
+    if mongo_uri.startswith(MONGOMOCK_URI_PREFIX):
+        import mongomock
+        return mongomock.MongoClient()
+
+    import pymongo
+    return pymongo.MongoClient(mongo_uri)
+
+
+class OutputSink(abc.ABC):
+
+    # Destination of the builder collections ('event_log', 'patients' and 'activity_log'). Documents are buffered per
+    # collection and written in batches of 'batch_size' documents by the subclass 'write_batch'
+
+    name = None
+    default_batch_size = 1000
+
+    def __init__(self, batch_size=None):
+        if batch_size is None:
+            batch_size = self.default_batch_size
+
+        if batch_size < 1:
+            raise ValueError("Batch size must be a positive number, got " + str(batch_size))
+
+        self.batch_size = batch_size
+
+        self.buffers = {}
+        self.inserted_documents = {}
+        self.insertion_time = {}
+
+    @abc.abstractmethod
+    def drop_collection(self, collection_name):
+        pass
+
+    @abc.abstractmethod
+    def write_batch(self, collection_name, documents):
+        pass
+
+    def reset_collection(self, collection_name):
+        self.buffers[collection_name] = []
+        self.drop_collection(collection_name)
+
+    def insert(self, collection_name, document):
+        buffer = self.buffers.setdefault(collection_name, [])
+        buffer.append(document)
+
+        if len(buffer) >= self.batch_size:
+            self.flush(collection_name)
+
+    def insert_many(self, collection_name, documents):
+        for document in documents:
+            self.insert(collection_name, document)
+
+    def flush(self, collection_name=None):
+        collection_names = list(self.buffers.keys()) if collection_name is None else [collection_name]
+
+        for name in collection_names:
+            buffer = self.buffers.get(name, [])
+
+            if len(buffer) > 0:
+                start_time = time.time()
+                self.write_batch(name, buffer)
+
+                self.insertion_time[name] = self.insertion_time.get(name, 0.0) + time.time() - start_time
+                self.inserted_documents[name] = self.inserted_documents.get(name, 0) + len(buffer)
+
+            self.buffers[name] = []
+
+    def close(self):
+        self.flush()
+
+    def throughput(self):
+        # Inserted documents, insertion time (secs.) and documents per second of each collection
+        result = {}
+
+        for name, inserted_documents in self.inserted_documents.items():
+            insertion_time = self.insertion_time[name]
+            result[name] = (inserted_documents,
+                            insertion_time,
+                            inserted_documents / insertion_time if insertion_time > 0 else float('inf'))
+
+        return result
+
+
+class MongoSink(OutputSink):
+
+    # Unordered 'insert_many' calls, instead of a network round trip per document. Any database object with the
+    # pymongo API can be used (e.g. a 'mongomock' database). Documents can be read and deleted as well, for the
+    # incremental rebuild (see 'incremental_build')
+
+    name = 'MongoDB'
+
+    def __init__(self, mongo_db, batch_size=None):
+        super().__init__(batch_size)
+        self.mongo_db = mongo_db
+
+    def drop_collection(self, collection_name):
+        if collection_name in self.mongo_db.list_collection_names():
+            self.mongo_db[collection_name].drop()
+
+    def write_batch(self, collection_name, documents):
+        self.mongo_db[collection_name].insert_many(documents, ordered=False)
+
+    def find_documents(self, collection_name, field=None, values=None, projection=None):
+        # All the documents of the collection, or those with 'field' in 'values'. Queries are split in batches of
+        # 'batch_size' values, as '$in' lists are bounded by the maximum document size
+        if field is None:
+            yield from self.mongo_db[collection_name].find({}, projection)
+        else:
+            values = list(values)
+            for start in range(0, len(values), self.batch_size):
+                yield from self.mongo_db[collection_name].find({field: {'$in': values[start:start + self.batch_size]}},
+                                                               projection)
+
+    def delete_documents(self, collection_name, field, values):
+        values = list(values)
+        for start in range(0, len(values), self.batch_size):
+            self.mongo_db[collection_name].delete_many({field: {'$in': values[start:start + self.batch_size]}})
+
+
+class ParquetSink(OutputSink):
+
+    # Columnar output (requires the 'pyarrow' package). Each collection is a directory of Parquet files, one per
+    # batch, optionally partitioned (Hive style, e.g. 'event_log/event_type=HOSP/') by a document field. Column types
+    # are inferred from the documents, so timestamps are stored as typed timestamp columns; columns mixing types
+    # (e.g. numeric and text diagnosis codes) are stored as text, and nested documents as JSON text if they cannot be
+    # stored as Parquet nested types. The schema of the whole collection is written in its '_common_metadata' file
+    # on close (see 'read_parquet_collection')
+
+    name = 'Parquet'
+    default_batch_size = 100000
+
+    def __init__(self, output_dir, batch_size=None, partition_by=None):
+        super().__init__(batch_size)
+
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+
+        self.output_dir = output_dir
+        self.partition_by = {} if partition_by is None else partition_by
+
+        self.schemas = {}
+        self.file_count = {}
+
+    def collection_dir(self, collection_name):
+        return os.path.join(self.output_dir, collection_name)
+
+    def drop_collection(self, collection_name):
+        self.schemas.pop(collection_name, None)
+        self.file_count[collection_name] = 0
+
+        if os.path.isdir(self.collection_dir(collection_name)):
+            shutil.rmtree(self.collection_dir(collection_name))
+
+    def column_array(self, values):
+        try:
+            return self.pa.array(values, from_pandas=True)
+        except (self.pa.ArrowInvalid, self.pa.ArrowTypeError):
+            return self.pa.array([None if value is None else
+                                  json.dumps(value, default=str) if isinstance(value, (dict, list)) else str(value)
+                                  for value in values], type=self.pa.string(), from_pandas=True)
+
+    def documents_table(self, documents, exclude=None):
+        # Union of the document fields, in order of appearance
+        fields = list(dict.fromkeys(field for document in documents for field in document if field != exclude))
+
+        return self.pa.table({field: self.column_array([document.get(field) for document in documents])
+                              for field in fields})
+
+    def write_batch(self, collection_name, documents):
+        partition_field = self.partition_by.get(collection_name)
+
+        if partition_field is None:
+            partitions = {None: documents}
+        else:
+            partitions = {}
+            for document in documents:
+                partitions.setdefault(document.get(partition_field), []).append(document)
+
+        for partition_value, partition_documents in partitions.items():
+
+            partition_dir = self.collection_dir(collection_name)
+            if partition_field is not None:
+                partition_dir = os.path.join(partition_dir, partition_field + "=" + str(partition_value))
+            os.makedirs(partition_dir, exist_ok=True)
+
+            table = self.documents_table(partition_documents, exclude=partition_field)
+
+            file_number = self.file_count.get(collection_name, 0)
+            self.file_count[collection_name] = file_number + 1
+            self.pq.write_table(table, os.path.join(partition_dir, "part-" + str(file_number).zfill(5) + ".parquet"))
+
+            if collection_name in self.schemas:
+                self.schemas[collection_name] = self.merge_schemas(self.schemas[collection_name], table.schema)
+            else:
+                self.schemas[collection_name] = table.schema
+
+    def merge_schemas(self, schema, other_schema):
+        # Fields with incompatible types in different files (e.g. numeric and text diagnosis codes in different
+        # partitions) are read as text
+        fields = []
+
+        for name in list(dict.fromkeys(schema.names + other_schema.names)):
+            field_schemas = [self.pa.schema([s.field(name)]) for s in [schema, other_schema]
+                             if s.get_field_index(name) >= 0]
+            try:
+                fields.append(self.pa.unify_schemas(field_schemas, promote_options='permissive').field(name))
+            except (self.pa.ArrowInvalid, self.pa.ArrowTypeError):
+                fields.append(self.pa.field(name, self.pa.string()))
+
+        return self.pa.schema(fields)
+
+    def close(self):
+        super().close()
+
+        for collection_name, schema in self.schemas.items():
+            self.pq.write_metadata(schema, os.path.join(self.collection_dir(collection_name), "_common_metadata"))
+
+
+def read_parquet_collection(output_dir, collection_name, columns=None):
+    # Reads a collection written by ParquetSink as a single pyarrow Table, using the schema of the whole collection.
+    # Only the 'columns' given are read, if any
+    import pyarrow.dataset
+    import pyarrow.parquet
+
+    collection_dir = os.path.join(output_dir, collection_name)
+    schema = pyarrow.parquet.read_schema(os.path.join(collection_dir, "_common_metadata"))
+
+    partitioning = pyarrow.dataset.HivePartitioning.discover(infer_dictionary=False)
+    dataset = pyarrow.dataset.dataset(collection_dir, format='parquet', partitioning=partitioning)
+
+    # Partition fields are not stored in the files
+    for field in dataset.schema:
+        if schema.get_field_index(field.name) < 0:
+            schema = schema.append(field)
+
+    return pyarrow.dataset.dataset(collection_dir, format='parquet', partitioning=partitioning,
+                                   schema=schema).to_table(columns=columns)
@@ -0,0 +1,141 @@
+import multiprocessing
+
+import episode_linking
+import input_data
+
+
+# Episode linking is independent across patients, so patients (and their events) are sharded by a hash of the
+# patient id and each shard is scattered, linked and closed in a worker process. Workers return compact results
+# (plain documents and episode flags, not Patient/Episode objects), and the parent process merges them
+# deterministically: episode ids do not depend on the processing order (see 'episode_linking.episode_id_of'), and the
+# diagnostics of the workers are merged (see 'episode_linking.Diagnostics'). The columnar linking engine is only
+# imported by the workers that use it.
+
+
+class LinkedEpisode:
+
+    # Episode flags and censoring times, and the activity log of censorable episodes (identified in some study
+    # window, see 'study_windows'). Provides the Episode attributes and methods used by the builder output
+
+    __slots__ = ['episode_id', 'stroke_episode', 'correct', 'left_censored', 'right_censored', 'incorrect_event',
+                 'bad_endpoint', 'episode_censoring_times', 'activity_documents']
+
+    def __init__(self, episode):
+        self.episode_id = episode.episode_id
+        self.stroke_episode = episode.stroke_episode
+        self.correct = episode.correct
+        self.left_censored = episode.left_censored
+        self.right_censored = episode.right_censored
+        self.incorrect_event = episode.incorrect_event
+        self.bad_endpoint = episode.bad_endpoint
+
+        self.episode_censoring_times = episode.censoring_times()
+
+        self.activity_documents = None
+        if episode.censorable():
+            self.activity_documents = episode.to_activity_dict()
+
+    def censorable(self):
+        return self.stroke_episode and self.correct
+
+    def censoring_times(self):
+        return self.episode_censoring_times
+
+    def activities(self):
+        return iter(self.activity_documents)
+
+    def to_activity_dict(self):
+        return self.activity_documents
+
+
+class LinkedPatient:
+
+    # Patient document, event documents and episodes of a linked patient. Provides the Patient attributes and
+    # methods used by the builder output
+
+    __slots__ = ['patient_id', 'patient_document', 'event_documents', 'episode_list']
+
+    def __init__(self, patient):
+        self.patient_id = patient.patient_id
+
+        self.patient_document = patient.to_dict()
+
+        self.event_documents = [event.to_dict() for episode in patient.episode_list for event in episode.event_list]
+
+        self.episode_list = [LinkedEpisode(episode) for episode in patient.episode_list]
+
+    def to_dict(self):
+        return self.patient_document
+
+
+def link_shard(shard):
+    shard_events, shard_patients_df, first_day_of_study, last_day_of_study, linking, check_linking, sample_size = shard
+
+    # Worker processes may be forked from the builder, so process-global state is set (or reset) for every shard
+    study_data = episode_linking.StudyData()
+    study_data.first_day_of_study = first_day_of_study
+    study_data.last_day_of_study = last_day_of_study
+
+    diagnostics = episode_linking.Diagnostics(sample_size)
+
+    patient_dict = episode_linking.build_patients(set(event.patient for event in shard_events), shard_patients_df,
+                                                  diagnostics)
+
+    if linking == 'columnar':
+        import columnar_linking
+
+        columnar_linking.scatter_events(patient_dict, shard_events, check=check_linking)
+    else:
+        episode_linking.scatter_events(patient_dict, shard_events)
+
+    for patient in patient_dict.values():
+        patient.close_episodes()
+
+    linked_patients = [LinkedPatient(patient) for patient in patient_dict.values()]
+
+    # Events of missing patients are not linked, but are part of the raw event log
+    unlinked_event_documents = [event.to_dict() for event in shard_events if event.patient not in patient_dict]
+
+    return linked_patients, unlinked_event_documents, diagnostics
+
+
+def link_in_parallel(event_list, patients_df, processes, first_day_of_study, last_day_of_study, linking='object',
+                     check_linking=False, diagnostics=None):
+    # Returns the linked patients (as a dictionary sorted by patient id) and the raw event documents. 'linking' is the
+    # linking engine ('object' or 'columnar', see 'columnar_linking'). Diagnostics of the workers are merged into
+    # 'diagnostics', if any
+
+    n_shards = processes
+
+    shard_events = [[] for _ in range(n_shards)]
+    for event in event_list:
+        shard_events[input_data.patient_shard(event.patient, n_shards)].append(event)
+
+    patients_shard = patients_df['patient_id'].map(lambda patient_id: input_data.patient_shard(patient_id, n_shards))
+
+    sample_size = 0 if diagnostics is None else diagnostics.sample_size
+
+    shards = [(shard_events[shard], patients_df[patients_shard == shard], first_day_of_study, last_day_of_study,
+               linking, check_linking, sample_size)
+              for shard in range(n_shards)]
+
+    with multiprocessing.Pool(processes) as pool:
+        shard_results = pool.map(link_shard, shards)
+
+    linked_patients = []
+    event_documents = []
+
+    for shard_linked_patients, unlinked_event_documents, shard_diagnostics in shard_results:
+        linked_patients.extend(shard_linked_patients)
+        event_documents.extend(unlinked_event_documents)
+
+        if diagnostics is not None:
+            diagnostics.merge(shard_diagnostics)
+
+    patient_dict = {}
+
+    for linked_patient in sorted(linked_patients, key=lambda p: p.patient_id):
+        patient_dict[linked_patient.patient_id] = linked_patient
+        event_documents.extend(linked_patient.event_documents)
+
+    return patient_dict, event_documents
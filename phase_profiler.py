@@ -0,0 +1,141 @@
+import cProfile
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+# Instrumentation of the builder phases. Each phase records its wall time, CPU time (of the builder process), peak
+# resident set size of the process so far, peak of the traced Python allocations during the phase (with
+# 'trace_memory', as tracing slows down allocations) and the number of rows processed per second. Phases can be
+# profiled with cProfile as well, one stats file per phase.
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+
+    # 'ru_maxrss' is in kilobytes on Linux, and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+
+
+class Phase:
+
+    __slots__ = ['name', 'wall_time', 'cpu_time', 'peak_rss_mb', 'tracemalloc_peak_mb', 'rows', 'rows_per_sec',
+                 'start_wall_time', 'start_cpu_time', 'profile']
+
+    # Fields of the phase in the report
+    REPORT_FIELDS = ['name', 'wall_time', 'cpu_time', 'peak_rss_mb', 'tracemalloc_peak_mb', 'rows', 'rows_per_sec']
+
+    def __init__(self, name):
+        self.name = name
+
+        self.wall_time = None
+        self.cpu_time = None
+        self.peak_rss_mb = None
+        self.tracemalloc_peak_mb = None
+        self.rows = None
+        self.rows_per_sec = None
+
+        self.profile = None
+
+        self.start_wall_time = time.perf_counter()
+        self.start_cpu_time = time.process_time()
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in Phase.REPORT_FIELDS}
+
+
+class PhaseProfiler:
+
+    def __init__(self, trace_memory=False, cprofile_dir=None):
+        self.trace_memory = trace_memory
+        self.cprofile_dir = cprofile_dir
+
+        self.phases = []
+        self.current_phase = None
+
+        if self.trace_memory:
+            tracemalloc.start()
+
+        if self.cprofile_dir is not None:
+            os.makedirs(self.cprofile_dir, exist_ok=True)
+
+    def start(self, name):
+        # A phase ends when the next one starts, if not stopped before
+        if self.current_phase is not None:
+            self.stop()
+
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+
+        self.current_phase = Phase(name)
+
+        if self.cprofile_dir is not None:
+            self.current_phase.profile = cProfile.Profile()
+            self.current_phase.profile.enable()
+
+    def stop(self, rows=None):
+        # Returns the recorded phase
+        phase = self.current_phase
+        self.current_phase = None
+
+        if phase.profile is not None:
+            phase.profile.disable()
+            phase.profile.dump_stats(os.path.join(self.cprofile_dir,
+                                                  str(len(self.phases)).zfill(2) + "_" + phase_file_name(phase.name) +
+                                                  ".prof"))
+            phase.profile = None
+
+        phase.wall_time = time.perf_counter() - phase.start_wall_time
+        phase.cpu_time = time.process_time() - phase.start_cpu_time
+        phase.peak_rss_mb = peak_rss_mb()
+
+        if self.trace_memory:
+            phase.tracemalloc_peak_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+
+        if rows is not None:
+            phase.rows = rows
+            phase.rows_per_sec = rows / phase.wall_time if phase.wall_time > 0 else None
+
+        self.phases.append(phase)
+
+        return phase
+
+    def close(self):
+        # Stops the tracing of the Python allocations, so later work of the process (e.g. the next build of a
+        # long-lived process) is not slowed down
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def report(self, **extra):
+        # Phases and total times, with any additional (JSON serializable) items, e.g. the builder statistics
+        result = {'phases': [phase.to_dict() for phase in self.phases],
+                  'total_wall_time': sum(phase.wall_time for phase in self.phases),
+                  'total_cpu_time': sum(phase.cpu_time for phase in self.phases),
+                  'peak_rss_mb': peak_rss_mb()}
+        result.update(extra)
+
+        return result
+
+    def write_report(self, path, **extra):
+        # '-' writes the report to the standard output
+        report = json.dumps(self.report(**extra), indent=2, default=str)
+
+        if path == '-':
+            print(report)
+        else:
+            with open(path, 'w') as f:
+                f.write(report + "\n")
+
+
+def phase_file_name(name):
+    return "".join(c if c.isalnum() else "_" for c in name.lower())
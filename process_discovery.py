@@ -0,0 +1,344 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from tabulate import tabulate
+
+import output_sinks
+
+
+# Process discovery over the activity log, without exporting it to R. Cases (episodes) and activities are encoded as
+# integers and the activities of each case are sorted by timestamp (activity log order on ties, missing timestamps
+# last), so the directly-follows graph, the trace variants and their durations are computed with NumPy over the whole
+# log at once:
+#
+#   * 'directly_follows': edges between consecutive activities of the cases (and from 'Start' and to 'End'), with their
+#     frequency and the mean and median transition duration (hours)
+#   * 'variants': trace variants with their frequency, cumulative coverage and mean and median case duration (hours)
+#   * 'filter_variants': cases of the most frequent variants that cover a share of the cases, as the dashboard process
+#     maps filter them (see 'activity_aggregates')
+#
+# Logs can be read from activity log documents (e.g. 'Episode.activities'), the Parquet or MongoDB output of the
+# builder, or any case, activity and timestamp columns.
+
+ACTIVITY_FIELDS = ["id", "event", "timestamp"]
+
+START_ACTIVITY = 'Start'
+END_ACTIVITY = 'End'
+
+VARIANT_SEPARATOR = ','
+
+# Columns of the directly-follows edges and trace variants DataFrames (empty logs have no rows)
+DIRECTLY_FOLLOWS_COLUMNS = ['from_activity', 'to_activity', 'frequency', 'mean_hours', 'median_hours']
+VARIANT_COLUMNS = ['rank', 'variant', 'activities', 'episodes', 'relative_frequency', 'cumulative_frequency',
+                   'mean_hours', 'median_hours']
+
+HOUR = np.timedelta64(3600, 's')
+
+
+def hours(timedeltas):
+    # NaN for missing values
+    return timedeltas / HOUR
+
+
+def group_means(groups, values, group_count):
+    # Mean of the non-NaN values of each group (NaN for groups without values)
+    known = ~np.isnan(values)
+
+    counts = np.bincount(groups[known], minlength=group_count)
+    sums = np.bincount(groups[known], weights=values[known], minlength=group_count)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def group_medians(groups, values, group_count):
+    # Median of the non-NaN values of each group (NaN for groups without values)
+    known = ~np.isnan(values)
+    groups = groups[known]
+    values = values[known]
+
+    order = np.lexsort((values, groups))
+    groups = groups[order]
+    values = values[order]
+
+    counts = np.bincount(groups, minlength=group_count)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    result = np.full(group_count, np.nan)
+
+    has_values = counts > 0
+    lower = starts[has_values] + (counts[has_values] - 1) // 2
+    upper = starts[has_values] + counts[has_values] // 2
+    result[has_values] = (values[lower] + values[upper]) / 2
+
+    return result
+
+
+class ActivityLog:
+
+    # Encoded activity log, sorted by case and timestamp: 'cases' and 'activities' are indices into 'case_ids' and
+    # 'activity_names' (sorted), and 'timestamps' are datetime64[us] (NaT for missing values). Use the 'from_*'
+    # constructors to encode a log
+
+    __slots__ = ['cases', 'activities', 'timestamps', 'case_ids', 'activity_names', 'case_starts']
+
+    def __init__(self, cases, activities, timestamps, case_ids, activity_names):
+        self.cases = cases
+        self.activities = activities
+        self.timestamps = timestamps
+
+        self.case_ids = case_ids
+        self.activity_names = activity_names
+
+        # Index of the first activity of each case
+        self.case_starts = np.flatnonzero(np.concatenate(([len(cases) > 0], cases[1:] != cases[:-1])))
+
+    @classmethod
+    def from_columns(cls, case_ids, activities, timestamps):
+        # Columns of equal length, in activity log order
+        cases, case_ids = pd.factorize(np.asarray(case_ids, dtype=object))
+        activities, activity_names = pd.factorize(np.asarray(activities, dtype=object), sort=True)
+        # Empty logs have no timestamps to infer the type from
+        timestamps = pd.to_datetime(pd.Series(timestamps, dtype=object if len(timestamps) == 0 else None)) \
+            .values.astype('datetime64[us]')
+
+        # Stable sort, so activities with the same timestamp keep the activity log order
+        order = np.lexsort((timestamps, np.isnat(timestamps), cases))
+
+        return cls(cases[order], activities[order], timestamps[order], np.asarray(case_ids, dtype=object),
+                   np.asarray(activity_names, dtype=object))
+
+    @classmethod
+    def from_documents(cls, documents):
+        # Activity log documents, e.g. 'Episode.activities' of several episodes
+        case_ids = []
+        activities = []
+        timestamps = []
+
+        for document in documents:
+            case_ids.append(document['id'])
+            activities.append(document['event'])
+            timestamps.append(document.get('timestamp'))
+
+        return cls.from_columns(case_ids, activities, timestamps)
+
+    @classmethod
+    def from_episodes(cls, episodes):
+        return cls.from_documents(document for episode in episodes for document in episode.activities())
+
+    @classmethod
+    def from_parquet(cls, output_dir):
+        # 'activity_log' collection of the Parquet output of the builder
+        table = output_sinks.read_parquet_collection(output_dir, "activity_log", columns=ACTIVITY_FIELDS)
+
+        return cls.from_columns(table.column('id').to_numpy(zero_copy_only=False),
+                                table.column('event').to_numpy(zero_copy_only=False),
+                                table.column('timestamp').to_pandas())
+
+    @classmethod
+    def from_mongo(cls, mongo_db):
+        # 'activity_log' collection of the MongoDB output of the builder
+        return cls.from_documents(mongo_db["activity_log"].find({}, ACTIVITY_FIELDS))
+
+    def __len__(self):
+        return len(self.cases)
+
+    def case_count(self):
+        return len(self.case_starts)
+
+    def case_lengths(self):
+        return np.diff(np.append(self.case_starts, len(self.cases)))
+
+    def select_cases(self, case_mask):
+        # Log of the cases (boolean mask over 'case_ids') selected, with the same encoding
+        selected = case_mask[self.cases]
+
+        return ActivityLog(self.cases[selected], self.activities[selected], self.timestamps[selected], self.case_ids,
+                           self.activity_names)
+
+
+def directly_follows(log, start_end=True):
+    # Edges of consecutive activities of each case (and from 'Start' to the first activity and from the last activity
+    # to 'End' of each case, with 'start_end'), with their frequency and the mean and median duration between both
+    # activities. Returns a DataFrame sorted by frequency
+    if log.case_count() == 0:
+        return pd.DataFrame(columns=DIRECTLY_FOLLOWS_COLUMNS)
+
+    activity_count = len(log.activity_names)
+    start_code = activity_count
+    end_code = activity_count + 1
+    code_count = activity_count + 2
+
+    same_case = log.cases[1:] == log.cases[:-1]
+
+    from_codes = log.activities[:-1][same_case]
+    to_codes = log.activities[1:][same_case]
+    durations = hours(log.timestamps[1:][same_case] - log.timestamps[:-1][same_case])
+
+    if start_end and log.case_count() > 0:
+        case_ends = np.append(log.case_starts[1:], len(log)) - 1
+
+        from_codes = np.concatenate((from_codes, np.full(log.case_count(), start_code), log.activities[case_ends]))
+        to_codes = np.concatenate((to_codes, log.activities[log.case_starts], np.full(log.case_count(), end_code)))
+        durations = np.concatenate((durations, np.full(2 * log.case_count(), np.nan)))
+
+    edges = from_codes * code_count + to_codes
+    edge_count = code_count * code_count
+
+    frequencies = np.bincount(edges, minlength=edge_count)
+    mean_hours = group_means(edges, durations, edge_count)
+    median_hours = group_medians(edges, durations, edge_count)
+
+    names = np.append(log.activity_names, [START_ACTIVITY, END_ACTIVITY])
+    found = np.flatnonzero(frequencies)
+
+    result = pd.DataFrame({'from_activity': names[found // code_count],
+                           'to_activity': names[found % code_count],
+                           'frequency': frequencies[found],
+                           'mean_hours': mean_hours[found],
+                           'median_hours': median_hours[found]})
+
+    return result.sort_values(['frequency', 'from_activity', 'to_activity'], ascending=[False, True, True],
+                              ignore_index=True)
+
+
+def case_variants(log):
+    # Variants (arrays of activity codes) and the variant index of each case. Cases are grouped by length, so the
+    # activities of the cases of each length are compared at once as the rows of a matrix
+    lengths = log.case_lengths()
+
+    variant_codes = []
+    case_variant = np.empty(log.case_count(), dtype=np.int64)
+
+    for length in np.unique(lengths):
+        length_cases = np.flatnonzero(lengths == length)
+        matrix = log.activities[log.case_starts[length_cases][:, np.newaxis] + np.arange(length)]
+
+        unique_rows, inverse = np.unique(matrix, axis=0, return_inverse=True)
+
+        case_variant[length_cases] = inverse.reshape(-1) + len(variant_codes)
+        variant_codes.extend(unique_rows)
+
+    return variant_codes, case_variant
+
+
+def variant_order(log, variant_codes, case_variant):
+    # Variant indices, most frequent first (ties by the activity names), and the cases of each variant
+    episodes = np.bincount(case_variant, minlength=len(variant_codes))
+    names = [tuple(log.activity_names[codes]) for codes in variant_codes]
+
+    return sorted(range(len(variant_codes)), key=lambda variant: (-episodes[variant], names[variant])), episodes
+
+
+def variants(log):
+    # Trace variants with their frequency, relative and cumulative frequency and the mean and median duration (hours)
+    # from the first to the last activity of the cases. Returns a DataFrame sorted by frequency
+    if log.case_count() == 0:
+        return pd.DataFrame(columns=VARIANT_COLUMNS)
+
+    variant_codes, case_variant = case_variants(log)
+    order, episodes = variant_order(log, variant_codes, case_variant)
+
+    case_ends = np.append(log.case_starts[1:], len(log)) - 1
+    case_hours = hours(log.timestamps[case_ends] - log.timestamps[log.case_starts])
+
+    mean_hours = group_means(case_variant, case_hours, len(variant_codes))
+    median_hours = group_medians(case_variant, case_hours, len(variant_codes))
+
+    ordered_episodes = episodes[order]
+
+    return pd.DataFrame({'rank': np.arange(1, len(order) + 1),
+                         'variant': [VARIANT_SEPARATOR.join(log.activity_names[variant_codes[variant]])
+                                     for variant in order],
+                         'activities': [len(variant_codes[variant]) for variant in order],
+                         'episodes': ordered_episodes,
+                         'relative_frequency': ordered_episodes / log.case_count(),
+                         'cumulative_frequency': np.cumsum(ordered_episodes) / log.case_count(),
+                         'mean_hours': mean_hours[order],
+                         'median_hours': median_hours[order]})
+
+
+def filter_variants(log, coverage):
+    # Log of the cases of the most frequent variants that cover 'coverage' of the cases, the last variant included
+    # being the one that reaches the coverage
+    if log.case_count() == 0:
+        return log
+
+    variant_codes, case_variant = case_variants(log)
+    order, episodes = variant_order(log, variant_codes, case_variant)
+
+    covered_before = np.concatenate(([0], np.cumsum(episodes[order])[:-1]))
+
+    selected_variants = np.zeros(len(variant_codes), dtype=bool)
+    selected_variants[np.asarray(order, dtype=np.int64)[covered_before < coverage * log.case_count()]] = True
+
+    case_mask = np.zeros(len(log.case_ids), dtype=bool)
+    case_mask[log.cases[log.case_starts]] = selected_variants[case_variant]
+
+    return log.select_cases(case_mask)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Process discovery over the activity log of the Code Stroke log '
+                                                 'generator')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--parquet-dir', type=str, default=None,
+                        help='Directory of the Parquet output of the builder')
+    source.add_argument('--mongo-uri', type=str, default=None,
+                        help='MongoDB connection URI of the output of the builder')
+    parser.add_argument('--coverage', type=float, default=1.0,
+                        help='Share of the episodes covered by the most frequent variants mined (default 1, all the '
+                             'episodes)')
+    parser.add_argument('--top', type=int, default=20,
+                        help='Number of variants and edges printed (default 20)')
+    parser.add_argument('--output-dir', type=str, default=None,
+                        help='Directory of the "directly_follows.csv" and "variants.csv" files of all the edges and '
+                             'variants (default: not written)')
+
+    args = parser.parse_args()
+
+    if not 0 < args.coverage <= 1:
+        print("Coverage must be greater than 0 and at most 1.", file=sys.stderr)
+        exit(-1)
+
+    try:
+        if args.parquet_dir is not None:
+            activity_log = ActivityLog.from_parquet(args.parquet_dir)
+        else:
+            activity_log = ActivityLog.from_mongo(output_sinks.mongo_client(args.mongo_uri)["stroke_"])
+    except Exception as e:
+        print("Error reading the activity log: " + str(e), file=sys.stderr)
+        exit(-1)
+
+    if activity_log.case_count() == 0:
+        print("Empty activity log")
+        exit(0)
+
+    if args.coverage < 1:
+        activity_log = filter_variants(activity_log, args.coverage)
+
+    print("Activity log: " + str(len(activity_log)) + " activities, " + str(activity_log.case_count()) +
+          " episodes, " + str(len(activity_log.activity_names)) + " activity types")
+
+    dfg_df = directly_follows(activity_log)
+    variants_df = variants(activity_log)
+
+    print("")
+    print("Directly-follows edges")
+    print(tabulate(dfg_df.head(args.top), headers='keys', tablefmt='psql', showindex=False, floatfmt='.2f'))
+
+    print("")
+    print("Trace variants")
+    print(tabulate(variants_df.head(args.top), headers='keys', tablefmt='psql', showindex=False, floatfmt='.3f'))
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+        dfg_df.to_csv(os.path.join(args.output_dir, 'directly_follows.csv'), index=False)
+        variants_df.to_csv(os.path.join(args.output_dir, 'variants.csv'), index=False)
+
+        print("Edges and variants written to '" + args.output_dir + "'")
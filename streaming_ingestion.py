@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import input_data
+
+
+# Streaming ingestion of inputs larger than the available memory. The input datasets are read in chunks and
+# partitioned on disk by a hash of the patient id, so every partition holds all the events and data of its patients and
+# can be linked on its own. Peak memory is then bounded by the largest partition instead of the full dataset.
+
+DATASETS = ['hospital_events', 'urgent_care_events', 'patients_data']
+
+
+def merge_dtype(dtype, other_dtype):
+    # Type of a column read at once, from the types of two of its chunks
+    if dtype is None or dtype == other_dtype:
+        return other_dtype
+
+    if dtype.kind in 'iuf' and other_dtype.kind in 'iuf':
+        return np.dtype('float64')
+
+    return np.dtype(object)
+
+
+class PartitionedInputs:
+
+    def __init__(self, input_paths, n_partitions, chunk_size, work_dir=None):
+        # 'input_paths' is a dictionary with the path of each dataset
+        self.input_paths = input_paths
+        self.n_partitions = n_partitions
+        self.chunk_size = chunk_size
+
+        self.work_dir = tempfile.mkdtemp(prefix='event_log_partitions_', dir=work_dir)
+
+        # Column types are resolved over the whole datasets, so every partition is read with the same types as if the
+        # dataset was read at once (e.g. numeric vs. text diagnosis codes)
+        self.dtypes = {}
+
+    def partition_path(self, dataset, partition):
+        return os.path.join(self.work_dir, dataset + "_" + str(partition).zfill(5) + ".csv")
+
+    def resolve_dtypes(self, dataset):
+        path = self.input_paths[dataset]
+        read_options = input_data.DATASET_READ_OPTIONS[dataset]
+
+        # Dates and converted columns are typed by their read options
+        typed_columns = set(read_options.get('parse_dates', [])) | set(read_options.get('converters', {}))
+        columns = [column for column in pd.read_csv(path, nrows=0).columns if column not in typed_columns]
+
+        dtypes = {}
+
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=self.chunk_size):
+            for column, dtype in chunk.dtypes.items():
+                dtypes[column] = merge_dtype(dtypes.get(column), dtype)
+
+        self.dtypes[dataset] = dtypes
+
+    def partition_dataset(self, dataset):
+        path = self.input_paths[dataset]
+
+        # Partition files are written with the original text of the input
+        header = pd.read_csv(path, nrows=0, dtype=str)
+        for partition in range(self.n_partitions):
+            header.to_csv(self.partition_path(dataset, partition), index=False)
+
+        for chunk in pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=self.chunk_size):
+            chunk_partitions = chunk['patient_id'].map(
+                lambda patient_id: input_data.patient_shard(patient_id, self.n_partitions))
+
+            for partition, partition_rows in chunk.groupby(chunk_partitions):
+                partition_rows.to_csv(self.partition_path(dataset, partition), mode='a', header=False, index=False)
+
+    def partition(self):
+        for dataset in DATASETS:
+            self.resolve_dtypes(dataset)
+            self.partition_dataset(dataset)
+
+    def read_partition(self, partition):
+        # Dictionary with the data frame of each dataset in the partition
+        return {dataset: input_data.read_dataset(dataset, self.partition_path(dataset, partition),
+                                                 dtype=self.dtypes[dataset])
+                for dataset in DATASETS}
+
+    def partitions(self):
+        for partition in range(self.n_partitions):
+            yield self.read_partition(partition)
+
+    def cleanup(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
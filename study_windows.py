@@ -0,0 +1,80 @@
+from datetime import datetime
+
+
+# Study windows of a builder run. Linking does not depend on the study window, only the censoring of the episodes
+# does (see 'Episode.censors'), so episodes are linked once and the censoring of every additional window is evaluated
+# with NumPy over the censoring times of all the episodes (start of the first event, and type and end of the last
+# event), with the same rules: correct stroke episodes starting before the first day of the window are left censored,
+# and those (not left censored) ending with an urgent care event later than 30 days before the end of the last day of
+# the window are right censored. Study windows are parsed before the builder imports the linking modules, which are
+# imported by the censoring only.
+
+DATE_FORMAT = '%Y-%m-%d'
+
+
+class StudyWindow:
+
+    __slots__ = ['first_day', 'last_day']
+
+    def __init__(self, first_day, last_day):
+        if first_day > last_day:
+            raise ValueError("First day of the study window " + first_day.strftime(DATE_FORMAT) + " is after its last "
+                             "day " + last_day.strftime(DATE_FORMAT))
+
+        self.first_day = first_day
+        self.last_day = last_day
+
+    @classmethod
+    def parse(cls, first_day, last_day):
+        # Days as 'YYYY-MM-DD' text
+        return cls(datetime.strptime(first_day, DATE_FORMAT), datetime.strptime(last_day, DATE_FORMAT))
+
+    def name(self):
+        return self.first_day.strftime('%Y%m%d') + "_" + self.last_day.strftime('%Y%m%d')
+
+    def collection_name(self, collection_name):
+        # Output collection of the window, e.g. 'activity_log_20160101_20161231'
+        return collection_name + "_" + self.name()
+
+    def __str__(self):
+        return self.first_day.strftime(DATE_FORMAT) + " - " + self.last_day.strftime(DATE_FORMAT)
+
+
+def datetime_array(values):
+    import pandas as pd
+
+    # NaT for missing values
+    return pd.to_datetime(pd.Series(values, dtype=object)).values.astype('datetime64[us]')
+
+
+class EpisodeCensoring:
+
+    # Censoring times of a list of episodes (Episode objects, or any object with the 'censorable' and
+    # 'censoring_times' methods), as arrays aligned with the list
+
+    def __init__(self, episodes):
+        import numpy as np
+
+        censoring_times = [episode.censoring_times() for episode in episodes]
+
+        self.censorable = np.array([episode.censorable() for episode in episodes], dtype=bool)
+
+        self.first_start_times = datetime_array([first_start_time for first_start_time, _, _ in censoring_times])
+        self.last_urgent_care = np.array([last_event_type == 'URG' for _, last_event_type, _ in censoring_times],
+                                         dtype=bool)
+        self.last_end_times = datetime_array([last_end_time for _, _, last_end_time in censoring_times])
+
+    def censor(self, window):
+        import numpy as np
+
+        import episode_linking
+
+        # (left, right) censoring flags of the episodes in the window
+        start_time = np.datetime64(episode_linking.study_start_time(window.first_day), 'us')
+        end_time = np.datetime64(episode_linking.study_end_time(window.last_day) -
+                                 episode_linking.RIGHT_CENSORING_MARGIN, 'us')
+
+        left_censored = self.censorable & (self.first_start_times < start_time)
+        right_censored = self.censorable & ~left_censored & self.last_urgent_care & (self.last_end_times > end_time)
+
+        return left_censored, right_censored
@@ -0,0 +1,310 @@
+import argparse
+import base64
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+
+# Synthetic RWD datasets with the schemas read by the event log builder: hospital events (with the secondary
+# diagnoses d2..d15 and their present on admission flags), urgent care events (with the S/N code stroke flag) and
+# patients data (one row per location of the location history). Patients are generated in chunks and appended to the
+# output files, so memory does not grow with the number of patients.
+#
+# Events of each patient are a chain in time: each event starts after the end of the previous one, either shortly
+# after (so both may be linked in the same episode) or weeks later (a new episode). Stroke prevalence is the fraction
+# of patients whose episodes have stroke diagnosis codes (and code stroke activations); censoring rates are the
+# fractions of patients whose events start before the study window, or in its last 30 days.
+
+HOSPITAL_EVENT_COLUMNS = ['event_id', 'patient_id', 'admission_time', 'surgery_time', 'discharge_time',
+                          'hospital_code', 'admission_type', 'discharge_code', 'discharge_service_code',
+                          'diagnosis_code', 'poa1'] + \
+                         [column for i in range(2, 16) for column in ['d' + str(i), 'poa' + str(i)]]
+
+URGENT_CARE_EVENT_COLUMNS = ['event_id', 'patient_id', 'admission_time', 'first_attention_time', 'ct_time',
+                             'observation_room_time', 'fibrinolysis_time', 'discharge_time', 'exit_time',
+                             'urgent_care_facility_code', 'discharge_code', 'discharge_service_code', 'diagnosis_code',
+                             'triage', 'code_stroke_activated']
+
+PATIENTS_DATA_COLUMNS = ['patient_id', 'dob', 'dod', 'sex', 'location_id', 'from_dt', 'to_dt']
+
+NON_STROKE_CODES = ['I10', 'E78.5', '780.6', '300.00', 'G91.1', 'R51', 'Z79.82', 'I67.1', 'G82.50', 'R42']
+
+FACILITY_CODES = [500021, 500055, 500114, 500204, 500310]
+
+MINUTE = np.timedelta64(1, 'm')
+SECOND = np.timedelta64(1, 's')
+DAY = np.timedelta64(1, 'D')
+
+
+class GeneratorOptions:
+
+    def __init__(self,
+                 patients=1000,
+                 events_per_patient=3.0,
+                 stroke_prevalence=0.6,
+                 left_censoring_rate=0.05,
+                 right_censoring_rate=0.05,
+                 linked_event_rate=0.6,
+                 hospital_event_rate=0.45,
+                 missing_patient_rate=0.01,
+                 first_day_of_study=datetime(2017, 1, 1),
+                 last_day_of_study=datetime(2017, 12, 31),
+                 chunk_size=100000,
+                 seed=1):
+        self.patients = patients
+        self.events_per_patient = events_per_patient
+        self.stroke_prevalence = stroke_prevalence
+        self.left_censoring_rate = left_censoring_rate
+        self.right_censoring_rate = right_censoring_rate
+        self.linked_event_rate = linked_event_rate
+        self.hospital_event_rate = hospital_event_rate
+        self.missing_patient_rate = missing_patient_rate
+        self.first_day_of_study = first_day_of_study
+        self.last_day_of_study = last_day_of_study
+        self.chunk_size = chunk_size
+        self.seed = seed
+
+
+def read_stroke_codes(stroke_codes='data/stroke_codes.csv'):
+    return pd.read_csv(stroke_codes, sep=";", encoding='utf-8-sig')['code'].astype(str).tolist()
+
+
+def random_times(rng, n, start, days):
+    # Times in the 'days' days from 'start', with second granularity
+    return np.datetime64(start, 's') + rng.integers(0, days * 86400, n) * SECOND
+
+
+def optional(rng, values, probability):
+    # Values with the given probability, NaT otherwise
+    return np.where(rng.random(len(values)) < probability, values, np.datetime64('NaT'))
+
+
+def codes(rng, n, stroke, stroke_codes):
+    return np.where(stroke, rng.choice(stroke_codes, n), rng.choice(NON_STROKE_CODES, n))
+
+
+def generate_patients(rng, options, n):
+    patient_ids = np.array([base64.b64encode(rng.bytes(16)).decode('ascii') for _ in range(n)], dtype=object)
+
+    # Study window starting times of the patients events
+    study_days = int((np.datetime64(options.last_day_of_study, 'D') -
+                      np.datetime64(options.first_day_of_study, 'D')) / DAY)
+
+    censoring = rng.random(n)
+    first_times = random_times(rng, n, options.first_day_of_study, max(study_days - 30, 1))
+    first_times = np.where(censoring < options.left_censoring_rate,
+                           random_times(rng, n, np.datetime64(options.first_day_of_study) - 60 * DAY, 60),
+                           first_times)
+    first_times = np.where((censoring >= options.left_censoring_rate) &
+                           (censoring < options.left_censoring_rate + options.right_censoring_rate),
+                           random_times(rng, n, np.datetime64(options.last_day_of_study) - 29 * DAY, 30),
+                           first_times)
+
+    stroke = rng.random(n) < options.stroke_prevalence
+
+    return patient_ids, first_times, stroke
+
+
+def generate_events(rng, options, patient_ids, first_times, stroke):
+    # One row per event, in chronological order for each patient
+    n_events = 1 + rng.poisson(max(options.events_per_patient - 1, 0), len(patient_ids))
+    patient = np.repeat(np.arange(len(patient_ids)), n_events)
+    n = len(patient)
+
+    hospital = rng.random(n) < options.hospital_event_rate
+
+    # Urgent care stays of 1 to 10 hours, hospitalisations of 0 to 30 days
+    durations = np.where(hospital, rng.choice([0, 1, 3, 10, 30], n) * DAY, rng.integers(60, 600, n) * MINUTE)
+
+    # Gap after each event: same day (linkable) or 10 to 400 days
+    linked = rng.random(n) < options.linked_event_rate
+    gaps = np.where(linked, rng.integers(1, 120, n) * MINUTE, rng.integers(10, 400, n) * DAY)
+
+    # Start of each event: first time of its patient plus the durations and gaps of its previous events
+    steps = (durations + gaps).astype('timedelta64[s]').astype(np.int64)
+    cumulative = np.cumsum(steps) - steps
+    patient_offsets = np.repeat(cumulative[np.cumsum(n_events) - n_events], n_events)
+    starts = first_times[patient] + (cumulative - patient_offsets) * SECOND
+
+    return patient, hospital, starts, durations
+
+
+def hospital_events(rng, patient_ids, stroke, patient, starts, durations, first_event_id, stroke_codes):
+    n = len(patient)
+
+    admissions = starts.astype('datetime64[D]')
+    discharges = (starts + durations).astype('datetime64[D]')
+    surgeries = optional(rng, admissions + rng.integers(0, 3, n) * DAY, 0.3)
+
+    events = pd.DataFrame({
+        'event_id': first_event_id + np.arange(n),
+        'patient_id': patient_ids[patient],
+        'admission_time': admissions,
+        'surgery_time': surgeries,
+        'discharge_time': discharges,
+        'hospital_code': rng.choice(FACILITY_CODES, n),
+        'admission_type': rng.integers(1, 3, n),
+        'discharge_code': rng.choice([1, 2, 4, 5, 20, 50], n, p=[0.4, 0.2, 0.1, 0.1, 0.15, 0.05]),
+        'discharge_service_code': '',
+        'diagnosis_code': codes(rng, n, stroke[patient], stroke_codes),
+        'poa1': rng.choice(['S', 'N', 'E'], n)})
+
+    # Secondary diagnoses: a random number of the first ones
+    n_secondary = rng.integers(0, 10, n)
+    for i in range(2, 16):
+        present = n_secondary >= i - 1
+        events['d' + str(i)] = np.where(present, rng.choice(NON_STROKE_CODES, n), '')
+        events['poa' + str(i)] = np.where(present, rng.choice(['S', 'N', ''], n), '')
+
+    return events[HOSPITAL_EVENT_COLUMNS]
+
+
+def urgent_care_events(rng, patient_ids, stroke, patient, starts, durations, first_event_id, stroke_codes):
+    n = len(patient)
+
+    # Some times are entered manually with a 5 minutes granularity
+    rounded_starts = (starts.astype('datetime64[m]').astype(np.int64) // 5 * 5).astype('datetime64[m]')
+    admissions = np.where(rng.random(n) < 0.3, rounded_starts, starts).astype('datetime64[s]')
+
+    first_attentions = optional(rng, admissions + rng.integers(60, 3600, n) * SECOND, 0.95)
+    ct_times = optional(rng, admissions + rng.integers(300, 12000, n) * SECOND, 0.5)
+    fibrinolysis_times = optional(rng, admissions + rng.integers(1200, 12000, n) * SECOND,
+                                  np.where(stroke[patient], 0.15, 0.0))
+    observation_times = optional(rng, admissions + rng.integers(3600, 18000, n) * SECOND, 0.4)
+    discharges = admissions + durations.astype('timedelta64[s]')
+    exits = optional(rng, discharges + rng.integers(0, 5400, n) * SECOND, 0.9)
+
+    # Manually entered CT times, with the previous year (as calendar dates, so there are no 29 February times that
+    # cannot be repaired to the admission year)
+    wrong_year = (rng.random(n) < 0.02) & ~np.isnat(ct_times) & ~np.isnat(first_attentions)
+    previous_year = (pd.DatetimeIndex(ct_times) - pd.DateOffset(years=1)).values.astype('datetime64[s]')
+    ct_times = np.where(wrong_year, previous_year, ct_times)
+
+    code_stroke = np.where(stroke[patient], rng.choice(['S', 'S', 'N', ''], n), rng.choice(['N', ''], n))
+
+    events = pd.DataFrame({
+        'event_id': first_event_id + np.arange(n),
+        'patient_id': patient_ids[patient],
+        'admission_time': admissions,
+        'first_attention_time': first_attentions,
+        'ct_time': ct_times,
+        'observation_room_time': observation_times,
+        'fibrinolysis_time': fibrinolysis_times,
+        'discharge_time': discharges,
+        'exit_time': exits,
+        'urgent_care_facility_code': rng.choice(FACILITY_CODES, n),
+        'discharge_code': rng.choice([1, 2, 6, 11], n, p=[0.3, 0.2, 0.4, 0.1]),
+        'discharge_service_code': rng.choice(['', '0U17'], n),
+        'diagnosis_code': codes(rng, n, stroke[patient], stroke_codes),
+        'triage': rng.integers(1, 6, n),
+        'code_stroke_activated': code_stroke})
+
+    return events[URGENT_CARE_EVENT_COLUMNS]
+
+
+def patients_data(rng, options, patient_ids):
+    # Patients without data are missing patients for the builder
+    patient_ids = patient_ids[rng.random(len(patient_ids)) >= options.missing_patient_rate]
+    n = len(patient_ids)
+
+    n_locations = rng.choice([1, 1, 2, 3], n)
+    patient = np.repeat(np.arange(n), n_locations)
+
+    dobs = np.datetime64('1930-01-01') + rng.integers(0, 20000, n) * DAY
+    dods = optional(rng, np.datetime64(options.last_day_of_study, 'D') - rng.integers(0, 365, n) * DAY, 0.05)
+
+    # Location changes between the first location and the study end; the last location of the history is open
+    location_number = np.arange(len(patient)) - np.repeat(np.cumsum(n_locations) - n_locations, n_locations)
+    changes = np.datetime64('2000-01-01') + \
+        np.sort(rng.integers(0, 6500, (n, 3)), axis=1)[patient, np.minimum(location_number, 2)] * DAY
+    from_dts = np.where(location_number == 0, np.datetime64('1998-08-01'), np.roll(changes, 1))
+    to_dts = np.where(location_number == n_locations[patient] - 1, np.datetime64('NaT'), changes)
+
+    return pd.DataFrame({
+        'patient_id': patient_ids[patient],
+        'dob': dobs[patient].astype('datetime64[s]'),
+        'dod': dods[patient].astype('datetime64[s]'),
+        'sex': rng.choice(['F', 'M'], n)[patient],
+        'location_id': rng.integers(2000, 6000, len(patient)),
+        'from_dt': from_dts.astype('datetime64[s]'),
+        'to_dt': to_dts.astype('datetime64[s]')})[PATIENTS_DATA_COLUMNS]
+
+
+def generate(output_dir, options, stroke_codes):
+    # Writes 'hospital_events.csv', 'urgent_care_events.csv' and 'patients_data.csv' in the output directory, and
+    # returns the number of rows of each file
+    rng = np.random.default_rng(options.seed)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    paths = {'hospital_events': os.path.join(output_dir, 'hospital_events.csv'),
+             'urgent_care_events': os.path.join(output_dir, 'urgent_care_events.csv'),
+             'patients_data': os.path.join(output_dir, 'patients_data.csv')}
+
+    rows = {dataset: 0 for dataset in paths}
+
+    for start in range(0, options.patients, options.chunk_size):
+        patient_ids, first_times, stroke = generate_patients(rng, options,
+                                                             min(options.chunk_size, options.patients - start))
+        patient, hospital, starts, durations = generate_events(rng, options, patient_ids, first_times, stroke)
+
+        chunk = {'hospital_events': hospital_events(rng, patient_ids, stroke, patient[hospital], starts[hospital],
+                                                    durations[hospital], 1000000 + rows['hospital_events'],
+                                                    stroke_codes),
+                 'urgent_care_events': urgent_care_events(rng, patient_ids, stroke, patient[~hospital],
+                                                          starts[~hospital], durations[~hospital],
+                                                          30000000 + rows['urgent_care_events'], stroke_codes),
+                 'patients_data': patients_data(rng, options, patient_ids)}
+
+        for dataset, dataset_df in chunk.items():
+            dataset_df.to_csv(paths[dataset], mode='w' if start == 0 else 'a', header=start == 0, index=False)
+            rows[dataset] += len(dataset_df)
+
+    return paths, rows
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Synthetic RWD datasets for the Code Stroke log generator')
+    parser.add_argument('output_dir', type=str, help='Directory of the generated CSV files')
+    parser.add_argument('--patients', type=int, default=1000, help='Number of patients (default 1000)')
+    parser.add_argument('--events-per-patient', type=float, default=3.0,
+                        help='Mean number of events per patient (default 3)')
+    parser.add_argument('--stroke-prevalence', type=float, default=0.6,
+                        help='Fraction of patients with stroke episodes (default 0.6)')
+    parser.add_argument('--left-censoring-rate', type=float, default=0.05,
+                        help='Fraction of patients whose events start before the study window (default 0.05)')
+    parser.add_argument('--right-censoring-rate', type=float, default=0.05,
+                        help='Fraction of patients whose events start in the last 30 days of the study window '
+                             '(default 0.05)')
+    parser.add_argument('--linked-event-rate', type=float, default=0.6,
+                        help='Fraction of events followed shortly by the next event of the patient (default 0.6)')
+    parser.add_argument('--hospital-event-rate', type=float, default=0.45,
+                        help='Fraction of events that are hospital events (default 0.45)')
+    parser.add_argument('--missing-patient-rate', type=float, default=0.01,
+                        help='Fraction of patients without patients data (default 0.01)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default 1)')
+
+    args = parser.parse_args()
+
+    if args.patients < 1:
+        print("Number of patients must be a positive number.", file=sys.stderr)
+        exit(-1)
+
+    generator_options = GeneratorOptions(patients=args.patients,
+                                         events_per_patient=args.events_per_patient,
+                                         stroke_prevalence=args.stroke_prevalence,
+                                         left_censoring_rate=args.left_censoring_rate,
+                                         right_censoring_rate=args.right_censoring_rate,
+                                         linked_event_rate=args.linked_event_rate,
+                                         hospital_event_rate=args.hospital_event_rate,
+                                         missing_patient_rate=args.missing_patient_rate,
+                                         seed=args.seed)
+
+    generated_paths, generated_rows = generate(args.output_dir, generator_options, read_stroke_codes())
+
+    for dataset, path in generated_paths.items():
+        print(path + ": " + str(generated_rows[dataset]) + " rows")
@@ -0,0 +1,56 @@
+import json
+import os
+import runpy
+import sys
+
+import mongomock
+import pymongo
+import pytest
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The builder modules are imported from the repository directory
+sys.path.insert(0, REPOSITORY_DIR)
+
+SAMPLE_DATA = [os.path.join(REPOSITORY_DIR, 'sample_input_data', 'stroke_' + dataset + '_AR_SAMPLE.csv')
+               for dataset in ['hospital_events', 'urgent_care_events', 'patients_data']]
+
+OUTPUT_COLLECTIONS = ['event_log', 'patients', 'activity_log']
+
+
+def without_ids(value):
+    # Documents without the '_id' set by MongoDB, including nested documents that were written on their own as well
+    # (e.g. the events of the patients)
+    if isinstance(value, dict):
+        return {key: without_ids(item) for key, item in value.items() if key != '_id'}
+    if isinstance(value, list):
+        return [without_ids(item) for item in value]
+    return value
+
+
+def canonical_documents(documents):
+    # Documents as sorted JSON text, so outputs written in a different order (or with NaN values) can be compared
+    return sorted(json.dumps(without_ids(document), sort_keys=True, default=str) for document in documents)
+
+
+@pytest.fixture
+def sample_data():
+    return list(SAMPLE_DATA)
+
+
+@pytest.fixture
+def run_builder(monkeypatch):
+    # Runs the event log builder script over an in-memory stand-in of the MongoDB server, shared by the runs of the
+    # test. Returns the output collections (see 'canonical_documents')
+    mongo_client = mongomock.MongoClient()
+    monkeypatch.setattr(pymongo, 'MongoClient', lambda *args, **kwargs: mongo_client)
+    monkeypatch.chdir(REPOSITORY_DIR)
+
+    def run(*options, input_paths=SAMPLE_DATA):
+        monkeypatch.setattr(sys, 'argv', ['event_log_builder.py'] + list(input_paths) + list(options))
+        runpy.run_path('event_log_builder.py', run_name='__main__')
+
+        return {collection_name: canonical_documents(mongo_client['stroke_'][collection_name].find())
+                for collection_name in OUTPUT_COLLECTIONS}
+
+    return run
@@ -0,0 +1,7 @@
+import pytest
+
+
+@pytest.mark.parametrize('processes', ['1', '2'])
+def test_columnar_linking_writes_the_same_output(run_builder, processes):
+    # '--check-linking' compares every episode with the object engine as well (see 'columnar_linking.check_equivalence')
+    assert run_builder('--linking', 'columnar', '--check-linking', '--processes', processes) == run_builder()
@@ -0,0 +1,35 @@
+import os
+
+# Sample data without a hospital event of a patient (changed patient) and without any row of another one (removed
+# patient)
+REMOVED_EVENT = '6761872,'
+REMOVED_PATIENT = 'eRxPH7267fNqdYjqgYNuHA=='
+
+
+def write_changed_data(input_paths, tmp_path):
+    changed_paths = []
+
+    for path in input_paths:
+        with open(path) as f:
+            lines = [line for line in f if not line.startswith(REMOVED_EVENT) and REMOVED_PATIENT not in line]
+
+        changed_path = str(tmp_path / ('changed_' + os.path.basename(path)))
+        with open(changed_path, 'w') as f:
+            f.writelines(lines)
+
+        changed_paths.append(changed_path)
+
+    return changed_paths
+
+
+def test_incremental_rebuild_writes_the_same_output_as_a_full_build(run_builder, sample_data, tmp_path):
+    changed_data = write_changed_data(sample_data, tmp_path)
+
+    full_output = run_builder()
+    changed_full_output = run_builder(input_paths=changed_data)
+    assert changed_full_output != full_output
+
+    # First incremental run (every patient), then changed, removed and new patients
+    assert run_builder('--incremental') == full_output
+    assert run_builder('--incremental', input_paths=changed_data) == changed_full_output
+    assert run_builder('--incremental') == full_output
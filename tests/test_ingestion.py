@@ -0,0 +1,2 @@
+def test_bulk_and_row_ingestion_write_the_same_output(run_builder):
+    assert run_builder('--ingestion', 'bulk') == run_builder('--ingestion', 'row')
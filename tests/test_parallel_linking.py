@@ -0,0 +1,6 @@
+import pytest
+
+
+@pytest.mark.parametrize('processes', ['2', '3'])
+def test_parallel_linking_writes_the_same_output(run_builder, processes):
+    assert run_builder('--processes', processes) == run_builder()
@@ -0,0 +1,41 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+import episode_linking
+import input_data
+
+from conftest import REPOSITORY_DIR, SAMPLE_DATA
+
+
+@pytest.fixture
+def urgent_care_df():
+    # Sample urgent care events (6) with manually entered CT and fibrinolysis times mismatching their admission by
+    # year, month and day, with a first attention time (first 3 events) and without it
+    episode_linking.StrokeCodes().stroke_codes_df = \
+        input_data.read_stroke_codes(os.path.join(REPOSITORY_DIR, 'data', 'stroke_codes.csv'))
+
+    urgent_care_df = input_data.read_dataset('urgent_care_events', SAMPLE_DATA[1])
+
+    admission_times = urgent_care_df['admission_time']
+    urgent_care_df['ct_time'] = admission_times + pd.Timedelta(minutes=37)
+    urgent_care_df['fibrinolysis_time'] = admission_times + pd.Timedelta(minutes=73)
+
+    for row, offset in enumerate([pd.DateOffset(years=-1), pd.DateOffset(months=-2), pd.DateOffset(days=-3)] * 2):
+        urgent_care_df.loc[row, 'ct_time'] += offset
+        urgent_care_df.loc[row, 'fibrinolysis_time'] += offset
+
+    urgent_care_df.loc[3:, 'first_attention_time'] = pd.NaT
+
+    return urgent_care_df
+
+
+def documents(events):
+    return [json.dumps(event.to_dict(), sort_keys=True, default=str) for event in events]
+
+
+def test_bulk_and_row_urgent_care_events_are_the_same(urgent_care_df):
+    assert documents(episode_linking.urgent_care_events_from_df(urgent_care_df)) == \
+           documents(episode_linking.urgent_care_events_from_rows(urgent_care_df))